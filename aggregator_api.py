@@ -1,86 +1,131 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel
-from PIL import Image
-import io
+from typing import Literal
+import orjson
+import asyncio
 from ranking_api import RankRequest, rank_phrases
 
 
 from updated_description_gen import (
-    generating_phrases,
+    generating_phrases_async,
     label_and_filter_phrases,
-    compose_safe_listing_description_from_phrases,
+    label_columns,
+    compose_safe_listing_description_async,
+    cached_description,
 )
-from ranking_api import rank_phrases
+from description_templates import compose_from_templates
+from ranking_api import rank_phrases, embed_anchor
 from tag_generator_api import generate_tags_from_llm
+from uploads import ImageUpload, read_image_upload
+from compose_jobs import compose_queue, ProgressFn, TERMINAL
+from profiling import mark as profile_mark
+from usage_meter import BudgetExceeded
+
+# Seconds between job-store checks while streaming job events
+JOB_EVENTS_POLL_INTERVAL = 0.5
 
 router = APIRouter(prefix="/compose", tags=["compose"])
 
 
 class ComposeResponse(BaseModel):
     safe_phrases: list[str]
-    all_labeled: list[dict]
+    # per-phrase dicts, or with compact=true columnar arrays: {"phrase": [...], "score": [...], ...}
+    all_labeled: list[dict] | dict[str, list]
     tags: list[str]
     safe_listing_description: str
 
 
+class ComposeJobAccepted(BaseModel):
+    job_id: str
+    status: str
+    poll_url: str
+    events_url: str
+
+
 class SafeDescriptionRequest(BaseModel):
     safe_phrases: list[str]
     title: str | None = ""
+    fresh: bool = False  # skip the response cache and ask the model for a new variant
+    # "template": local composer, no model call (drafts while editing)
+    # "auto": cached LLM text for these exact phrases if any, else the template
+    # "llm": model-written final ("polish") description
+    composer: Literal["llm", "template", "auto"] = "llm"
 
 
 class SafeDescriptionResponse(BaseModel):
     safe_listing_description: str
-
-
-@router.post("/all", response_model=ComposeResponse)
-async def compose_all(
-    title: str = Form(...),
-    nice_class: int = Form(...),
-    product_text: str = Form(default=""),
-    image_file: UploadFile = File(None),
-):
-    title = (title or "").strip()
-    if not title:
-        raise HTTPException(status_code=400, detail="title is required")
+    composer: str  # which composer produced the text: "llm", "template" or "cache"
+
+
+async def _read_compose_image(image_file: UploadFile | None) -> ImageUpload | None:
+    if image_file is None:
+        return None
+    content_type = image_file.content_type or "image/png"
+    if not content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    return await read_image_upload(image_file)
+
+
+async def run_compose(
+    title: str,
+    nice_class: int,
+    product_text: str,
+    img: ImageUpload | None,
+    progress: ProgressFn | None = None,
+    compact: bool = False,
+) -> dict:
+    """
+    The /compose/all pipeline. progress(stage) is called as each stage starts,
+    so the job API can report where a long request is; the same stage names
+    annotate request profiles. compact returns all_labeled as columnar arrays.
+    """
+    def stage(name: str) -> None:
+        profile_mark(name)
+        if progress is not None:
+            progress(name)
 
     # Generate description phrases and label them
+    anchor_text = "PRODUCT TEXT: " + product_text + " USER DESCRIPTION: " + title
     try:
-        generated_text = generating_phrases(title)
+        # Embed the shared anchor once; both phrase and tag ranking reuse it
+        stage("anchor")
+        try:
+            anchor_vector = await embed_anchor(anchor_text)
+        except BudgetExceeded:
+            anchor_vector = None  # ranking falls back to generation order
+        stage("phrases")
+        generated_text = await generating_phrases_async(title)
         labeled, safe = label_and_filter_phrases(generated_text)
         safe_phrases = [r["phrase"] for r in safe]
+        stage("ranking")
         RankRequestModel = RankRequest(
-            user_text= "PRODUCT TEXT: " + product_text + " USER DESCRIPTION: " + title,
-            phrases=safe_phrases)
+            user_text=anchor_text,
+            phrases=safe_phrases,
+            anchor_vector=anchor_vector)
         safe_phrases = await rank_phrases(RankRequestModel)
-        safe_listing_description = compose_safe_listing_description_from_phrases(
-        title=title,
-        safe_phrases=safe_phrases,
-    )
-
-
+        stage("description")
+        safe_listing_description = await compose_safe_listing_description_async(
+            title=title,
+            safe_phrases=safe_phrases,
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"description generation failed: {e}")
 
     # Generate tags only if image provided
     tags: list[str] = []
-    if image_file is not None:
-        content_type = image_file.content_type or "image/png"
-        if not content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="Invalid image file")
-        img_bytes = await image_file.read()
-        if not img_bytes:
-            raise HTTPException(status_code=400, detail="Empty image file")
-        try:
-            img = Image.open(io.BytesIO(img_bytes))
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
-
+    if img is not None:
+        stage("tags")
         try:
-            tags = await generate_tags_from_llm(nice_class=nice_class, product_text=product_text, image=img)
-            RankRequestModel = RankRequest(
-                user_text= "PRODUCT TEXT: " + product_text + " USER DESCRIPTION: " + title,
-                phrases=tags)
-            tags = await rank_phrases(RankRequestModel)
+            # Tags come back already ranked against the same anchor
+            tags = await generate_tags_from_llm(
+                nice_class=nice_class,
+                product_text=product_text,
+                image=img,
+                anchor_vector=anchor_vector,
+            )
         except HTTPException:
             raise
         except Exception as e:
@@ -88,12 +133,99 @@ async def compose_all(
 
     return {
         "safe_phrases": safe_phrases,
-        "all_labeled": labeled,
+        "all_labeled": label_columns(labeled) if compact else labeled,
         "tags": tags,
         "safe_listing_description": safe_listing_description,
     }
 
 
+@router.post("/all", response_model=ComposeResponse)
+async def compose_all(
+    title: str = Form(...),
+    nice_class: int = Form(...),
+    product_text: str = Form(default=""),
+    image_file: UploadFile = File(None),
+    compact: bool = Form(default=False),
+):
+    title = (title or "").strip()
+    if not title:
+        raise HTTPException(status_code=400, detail="title is required")
+    profile_mark("upload")
+    img = await _read_compose_image(image_file)
+    # run_compose builds plain lists/dicts; serialize directly instead of re-validating
+    return ORJSONResponse(await run_compose(title, nice_class, product_text, img, compact=compact))
+
+
+@router.post("/jobs", response_model=ComposeJobAccepted, status_code=202)
+async def submit_compose_job(
+    title: str = Form(...),
+    nice_class: int = Form(...),
+    product_text: str = Form(default=""),
+    image_file: UploadFile = File(None),
+    compact: bool = Form(default=False),
+):
+    """
+    Queue a /compose/all request and return immediately. Poll
+    GET /compose/jobs/{job_id} or stream GET /compose/jobs/{job_id}/events.
+    """
+    title = (title or "").strip()
+    if not title:
+        raise HTTPException(status_code=400, detail="title is required")
+    # read the upload now; the request body is gone once we return
+    img = await _read_compose_image(image_file)
+
+    try:
+        job = compose_queue.submit(
+            lambda progress: run_compose(title, nice_class, product_text, img, progress, compact),
+            kind="compose_all",
+        )
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Compose queue is full, try again shortly",
+            headers={"Retry-After": "5"},
+        )
+
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "poll_url": f"/compose/jobs/{job['id']}",
+        "events_url": f"/compose/jobs/{job['id']}/events",
+    }
+
+
+@router.get("/jobs/{job_id}")
+async def get_compose_job(job_id: str):
+    job = await compose_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+    return ORJSONResponse(job)
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_compose_job(job_id: str):
+    """Server-sent events: one 'progress' event per change, then a final 'done' or 'failed'."""
+    if await compose_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+
+    async def events():
+        last = None
+        while True:
+            job = await compose_queue.get(job_id)
+            if job is None:
+                yield "event: failed\ndata: {\"detail\": \"job expired\"}\n\n"
+                return
+            if job["updated_at"] != last:
+                last = job["updated_at"]
+                event = job["status"] if job["status"] in TERMINAL else "progress"
+                yield f"event: {event}\ndata: {orjson.dumps(job).decode()}\n\n"
+                if job["status"] in TERMINAL:
+                    return
+            await asyncio.sleep(JOB_EVENTS_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @router.post("/safe-description", response_model=SafeDescriptionResponse)
 async def compose_safe_description(payload: SafeDescriptionRequest):
     safe_phrases = [p.strip() for p in payload.safe_phrases if p and p.strip()]
@@ -103,9 +235,18 @@ async def compose_safe_description(payload: SafeDescriptionRequest):
             detail="safe_phrases must include at least one non-empty phrase",
         )
 
-    description = compose_safe_listing_description_from_phrases(
-        title=payload.title or "",
+    title = payload.title or ""
+    if payload.composer == "auto":
+        cached = await asyncio.to_thread(cached_description, title, safe_phrases)
+        if cached is not None:
+            return {"safe_listing_description": cached, "composer": "cache"}
+    if payload.composer != "llm":
+        return {"safe_listing_description": compose_from_templates(title, safe_phrases), "composer": "template"}
+
+    description = await compose_safe_listing_description_async(
+        title=title,
         safe_phrases=safe_phrases,
+        use_cache=not payload.fresh,
     )
 
-    return {"safe_listing_description": description}
\ No newline at end of file
+    return {"safe_listing_description": description, "composer": "llm"}
\ No newline at end of file
@@ -0,0 +1,171 @@
+# cache_store.py
+import os
+import json
+import asyncio
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import CACHE_DB_PATH, CACHE_ENABLED, CACHE_SWEEP_INTERVAL
+from tracing import span
+
+# sqlite3 connections can't be shared across threads (asyncio.to_thread) or
+# processes (uvicorn workers), so each thread in each process opens its own.
+_local = threading.local()
+_sweeper_lock = threading.Lock()
+_sweeper_pid: Optional[int] = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (ns, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS kv_expires_at ON kv(expires_at);
+"""
+
+
+def _connect() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    folder = os.path.dirname(CACHE_DB_PATH)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=5.0, isolation_level=None, check_same_thread=False)
+    # WAL: readers in every worker never block on the single writer.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _start_sweeper()
+    return conn
+
+
+def _start_sweeper() -> None:
+    # one per process (a fork doesn't inherit the thread), never on a request's thread
+    global _sweeper_pid
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweep_loop, name="cache-sweep", daemon=True).start()
+
+
+def _sweep_loop() -> None:
+    while True:
+        try:
+            _connect().execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            print(f"cache sweep failed: {e}")
+        time.sleep(CACHE_SWEEP_INTERVAL)
+
+
+def get_db() -> sqlite3.Connection:
+    """This thread's connection to the shared cache file, for modules that keep their own tables."""
+    return _connect()
+
+
+def make_key(*parts: Any) -> str:
+    """Stable hash for any JSON-serializable key parts."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SharedCache:
+    """
+    Namespaced JSON key/value cache backed by one SQLite file, so every
+    worker process benefits from upstream calls made by the others.
+    Cache errors are logged and treated as misses; they never fail a request.
+    Calls can wait up to the 5s busy timeout while another process writes,
+    so coroutines use the *_async variants, which run in a worker thread.
+    """
+
+    def __init__(self, namespace: str, ttl: Optional[float] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    async def get_async(self, key: str) -> Any:
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key: str, value: Any) -> None:
+        await asyncio.to_thread(self.set, key, value)
+
+    def get(self, key: str) -> Any:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        if not CACHE_ENABLED or not keys:
+            return {}
+        with span("cache.get", ns=self.namespace, keys=len(keys)) as s:
+            out = self._get_many(keys)
+            s.set(hits=len(out))
+        return out
+
+    def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        now = time.time()
+        try:
+            conn = _connect()
+            # stay well under SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, value, expires_at FROM kv WHERE ns = ? AND key IN ({marks})",
+                    [self.namespace, *chunk],
+                ).fetchall()
+                for key, value, expires_at in rows:
+                    if expires_at is None or expires_at >= now:
+                        out[key] = json.loads(value)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"cache[{self.namespace}] read failed: {e}")
+            return {}
+        return out
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        if not CACHE_ENABLED or not items:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else None
+        rows = [(self.namespace, k, json.dumps(v), expires_at) for k, v in items.items()]
+        try:
+            conn = _connect()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT OR REPLACE INTO kv (ns, key, value, expires_at) VALUES (?, ?, ?, ?)", rows)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"cache[{self.namespace}] write failed: {e}")
+
+    def increment(self, counts: Dict[str, int], field: str) -> None:
+        """Add to a numeric field of stored JSON values in place: one UPDATE per key, no read-modify-write."""
+        if not CACHE_ENABLED or not counts:
+            return
+        path = f"$.{field}"
+        rows = [(path, path, n, self.namespace, k) for k, n in counts.items()]
+        try:
+            conn = _connect()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "UPDATE kv SET value = json_set(value, ?, COALESCE(json_extract(value, ?), 0) + ?) WHERE ns = ? AND key = ?",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            print(f"cache[{self.namespace}] increment failed: {e}")
+
+    def delete(self, key: str) -> None:
+        if not CACHE_ENABLED:
+            return
+        try:
+            _connect().execute("DELETE FROM kv WHERE ns = ? AND key = ?", (self.namespace, key))
+        except sqlite3.Error as e:
+            print(f"cache[{self.namespace}] delete failed: {e}")
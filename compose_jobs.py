@@ -0,0 +1,123 @@
+# compose_jobs.py
+import asyncio
+import contextvars
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+from cache_store import SharedCache
+from config import COMPOSE_JOB_WORKERS, COMPOSE_QUEUE_MAX, COMPOSE_JOB_TTL
+
+# Job records live in the shared store so a poll can land on any worker process.
+_store = SharedCache("jobs", ttl=COMPOSE_JOB_TTL)
+
+TERMINAL = {"done", "failed"}
+
+# Store writes go through one thread: off the event loop, and applied in order
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compose-jobs-store")
+
+ProgressFn = Callable[[str], None]
+JobFn = Callable[[ProgressFn], Awaitable[Any]]
+
+
+class JobQueue:
+    """
+    Bounded in-process job queue drained by a fixed pool of asyncio workers.
+    submit() raises asyncio.QueueFull when max_depth jobs are already waiting,
+    so overload turns into an immediate rejection instead of a slow timeout.
+    Jobs of this process are served from memory until their final state has
+    been written; everything else is read from the shared store.
+    """
+
+    def __init__(self, workers: int, max_depth: int):
+        self._workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._max_depth = max_depth
+        self._tasks: list[asyncio.Task] = []
+        self._live: Dict[str, Dict[str, Any]] = {}
+
+    def _ensure_started(self) -> asyncio.Queue:
+        # created lazily so the queue binds to the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self._max_depth)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        return self._queue
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _save(self, job: Dict[str, Any]) -> None:
+        job["updated_at"] = time.time()
+        self._live[job["id"]] = job
+        snapshot = {**job, "stages": list(job["stages"])}
+        _writer.submit(self._write, snapshot)
+
+    def _write(self, snapshot: Dict[str, Any]) -> None:
+        _store.set(snapshot["id"], snapshot)
+        if snapshot["status"] in TERMINAL:
+            self._live.pop(snapshot["id"], None)
+
+    def submit(self, fn: JobFn, kind: str) -> Dict[str, Any]:
+        queue = self._ensure_started()
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "stage": None,
+            "stages": [],
+            "created_at": now,
+            "updated_at": now,
+            "result": None,
+            "error": None,
+        }
+        # run under the submitter's context (tenant, profile), not the worker's
+        queue.put_nowait((job, fn, contextvars.copy_context()))  # raises asyncio.QueueFull
+        self._save(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._live.get(job_id)
+        if job is not None:
+            return job
+        return await _store.get_async(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job, fn, ctx = await self._queue.get()
+            try:
+                await asyncio.create_task(self._run(job, fn), context=ctx)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Dict[str, Any], fn: JobFn) -> None:
+        def progress(stage: str) -> None:
+            job["stage"] = stage
+            job["stages"].append({"stage": stage, "at": time.time()})
+            self._save(job)
+
+        job["status"] = "running"
+        self._save(job)
+        try:
+            job["result"] = await fn(progress)
+            job["status"] = "done"
+        except HTTPException as e:
+            job["status"] = "failed"
+            job["error"] = {"status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            print(f"compose job {job['id']} failed: {e}")
+            job["status"] = "failed"
+            job["error"] = {"status_code": 500, "detail": str(e)}
+        finally:
+            # cancelled (e.g. shutdown) or a BaseException: still leave a final state for pollers
+            if job["status"] not in TERMINAL:
+                job["status"] = "failed"
+                job["error"] = {"status_code": 503, "detail": "cancelled"}
+            job["stage"] = None
+            self._save(job)
+
+compose_queue = JobQueue(workers=COMPOSE_JOB_WORKERS, max_depth=COMPOSE_QUEUE_MAX)
@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 import google.generativeai as genai
 
@@ -15,9 +16,121 @@ genai.configure(api_key=GOOGLE_API_KEY)
 MODEL_ID = "gemini-2.5-flash-lite"
 EMB_MODEL_ID = "text-embedding-004"
 
+# Shared on-disk cache (SQLite, WAL mode) used by every worker process.
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(".cache", "tagsafe.sqlite3"))
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1").lower() not in {"0", "false", "no"}
+# Seconds between background deletes of expired rows (one sweeper thread per process)
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", 3600))
+# TTLs in seconds; embeddings are deterministic per model so they never expire.
+EMBED_CACHE_TTL = None
+# embed_content accepts at most 100 texts per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 100))
+EMBED_PARALLELISM = int(os.getenv("EMBED_PARALLELISM", 4))
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", 2))
+# In-process embedding tier: "int8", "float16" or "none"
+EMBED_MEMORY_DTYPE = os.getenv("EMBED_MEMORY_DTYPE", "float16")
+EMBED_MEMORY_MAX = int(os.getenv("EMBED_MEMORY_MAX", 1_000_000))
+TM_CACHE_TTL = float(os.getenv("TM_CACHE_TTL", 24 * 3600))
+PARSE_CACHE_TTL = float(os.getenv("PARSE_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))
+LLM_CACHE_MAX_ITEMS = int(os.getenv("LLM_CACHE_MAX_ITEMS", 2048))
+# /compose/jobs: per-process worker pool, admission cap and result retention
+COMPOSE_JOB_WORKERS = int(os.getenv("COMPOSE_JOB_WORKERS", 4))
+COMPOSE_QUEUE_MAX = int(os.getenv("COMPOSE_QUEUE_MAX", 32))
+COMPOSE_JOB_TTL = float(os.getenv("COMPOSE_JOB_TTL", 3600))
+# Micro-batching of concurrent phrase/description generation calls
+LLM_BATCHING = os.getenv("LLM_BATCHING", "1").lower() not in {"0", "false", "no"}
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", 20))
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", 8))
+ANCHOR_TTL = float(os.getenv("ANCHOR_TTL", 24 * 3600))
+# Max concurrent USPTO checks in "first N safe" (early-exit) mode
+TM_EARLY_EXIT_CONCURRENCY = int(os.getenv("TM_EARLY_EXIT_CONCURRENCY", 8))
+# Stream tag generation and overlap it with USPTO checks (generate_tags_from_llm)
+TAG_STREAMING = os.getenv("TAG_STREAMING", "1").lower() not in {"0", "false", "no"}
+# Minimum cosine(product anchor, tag) for /tags/suggest to reuse an indexed tag.
+TAG_SUGGEST_MIN_SCORE = float(os.getenv("TAG_SUGGEST_MIN_SCORE", 0.6))
+
+# Reuse tags across near-identical uploads (image_dedupe.py): max differing bits of
+# the 64-bit dHash and pHash, and how long stored results stay reusable (seconds)
+IMAGE_DEDUPE_ENABLED = os.getenv("IMAGE_DEDUPE_ENABLED", "1").lower() not in {"0", "false", "no"}
+IMAGE_DEDUPE_MAX_DISTANCE = int(os.getenv("IMAGE_DEDUPE_MAX_DISTANCE", 6))
+IMAGE_DEDUPE_TTL = float(os.getenv("IMAGE_DEDUPE_TTL", 7 * 24 * 3600))
+
+# Upload limits for image endpoints
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+
+# Opt-in request profiling (profiling.py): header-triggered or sampled
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0").lower() not in {"0", "false", "no"}
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(".cache", "profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50))
+
+# Per-tenant usage accounting (usage_meter.py). Tenants are identified by this header.
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-API-Key")
+# Daily budgets per tenant as JSON, e.g. {"default": {"llm_tokens": 500000, "tm_calls": 1000}}.
+# Keys: llm_tokens, llm_calls, embed_texts, tm_calls. Tenant ids are listed by GET /usage.
+TENANT_BUDGETS = json.loads(os.getenv("TENANT_BUDGETS", "{}"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 5))
+USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", 500))
+
+# Priority scheduling of upstream calls (scheduler.py). Each request gets a traffic class from
+# TRAFFIC_CLASS_HEADER ("interactive" or "bulk") or its route (longest matching prefix, default interactive).
+TRAFFIC_CLASS_HEADER = os.getenv("TRAFFIC_CLASS_HEADER", "X-Traffic-Class")
+TRAFFIC_CLASS_ROUTES = json.loads(os.getenv("TRAFFIC_CLASS_ROUTES", "null")) or {
+    "/compose/jobs": "bulk",
+    "/tmcheck": "bulk",
+    "/ranking/rank-many": "bulk",
+}
+# Share of contended slots per class (weighted fair queuing)
+TRAFFIC_CLASS_WEIGHTS = json.loads(os.getenv("TRAFFIC_CLASS_WEIGHTS", "null")) or {"interactive": 4, "bulk": 1}
+# Concurrent calls per worker for each upstream, and the fraction only interactive calls may use
+UPSTREAM_LLM_CONCURRENCY = int(os.getenv("UPSTREAM_LLM_CONCURRENCY", 16))
+UPSTREAM_EMBED_CONCURRENCY = int(os.getenv("UPSTREAM_EMBED_CONCURRENCY", 8))
+UPSTREAM_TM_CONCURRENCY = int(os.getenv("UPSTREAM_TM_CONCURRENCY", 20))
+UPSTREAM_RESERVED_INTERACTIVE = float(os.getenv("UPSTREAM_RESERVED_INTERACTIVE", 0.25))
+# Threads for blocking work (asyncio.to_thread). Calls queued for an upstream slot park a thread,
+# so this must comfortably exceed the upstream limits or queued bulk calls could hold every thread.
+BLOCKING_THREADS = int(os.getenv("BLOCKING_THREADS", 64))
+
+# Confidence-gated tiers for /parser routes, cheapest first. A tier answers when its JSON is
+# valid and its confidence >= the route's threshold; otherwise the next tier is tried.
+# Tier keys: name, model, prompt ("minimal" or "full"), max_side (image only; null = full resolution).
+PARSE_STRONG_MODEL_ID = os.getenv("PARSE_STRONG_MODEL_ID", "gemini-2.5-flash")
+PARSE_IMAGE_TIERS = json.loads(os.getenv("PARSE_IMAGE_TIERS", "null")) or [
+    {"name": "fast", "model": MODEL_ID, "prompt": "minimal", "max_side": 768},
+    {"name": "strong", "model": PARSE_STRONG_MODEL_ID, "prompt": "full", "max_side": None},
+]
+PARSE_IMAGE_MIN_CONFIDENCE = float(os.getenv("PARSE_IMAGE_MIN_CONFIDENCE", 0.7))
+PARSE_TEXT_TIERS = json.loads(os.getenv("PARSE_TEXT_TIERS", "null")) or [
+    {"name": "fast", "model": MODEL_ID, "prompt": "minimal"},
+    {"name": "strong", "model": PARSE_STRONG_MODEL_ID, "prompt": "full"},
+]
+PARSE_TEXT_MIN_CONFIDENCE = float(os.getenv("PARSE_TEXT_MIN_CONFIDENCE", 0.7))
+
+# Startup warm-up (warmup.py): runs before a worker takes traffic
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1").lower() not in {"0", "false", "no"}
+# Also open upstream connections with tiny Gemini/RapidAPI calls
+WARMUP_UPSTREAM = os.getenv("WARMUP_UPSTREAM", "1").lower() not in {"0", "false", "no"}
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 20))
+# Request tracing (tracing.py): spans for LLM, embedding, USPTO, cache and ranking calls
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0").lower() not in {"0", "false", "no"}
+TRACE_HEADER = os.getenv("TRACE_HEADER", "X-Trace")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 1.0))
+# JSON-lines export ("" disables) and/or an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(".cache", "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+# Requests at least this slow get their critical path printed
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 2000))
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", 200))
+
 def get_model(model_id: str, **kwargs):
     """
-    Return a configured GenerativeModel instance.
+    Return a configured GenerativeModel instance, metered per tenant.
     kwargs forwarded to genai.GenerativeModel if needed.
     """
-    return genai.GenerativeModel(model_id, **kwargs)
\ No newline at end of file
+    from usage_meter import MeteredModel  # usage_meter imports this module
+    return MeteredModel(genai.GenerativeModel(model_id, **kwargs))
@@ -0,0 +1,115 @@
+# description_templates.py
+"""
+Deterministic, LLM-free listing descriptions built from safe phrases.
+
+Used for drafts while a seller edits their phrase selection and as the
+fallback when the model is unavailable. Only the given phrases plus neutral
+glue words are used, so nothing new (or trademarkable) is introduced; the
+same inputs always give the same text.
+"""
+import re
+import zlib
+from typing import List, Sequence
+
+MAX_PHRASES = 6
+
+# {a}, {b}: phrases. Several shapes per slot so neighbouring listings don't read alike.
+OPENERS_ONE = [
+    "{a}, made to stand out.",
+    "Say hello to {a}.",
+    "Meet {a}.",
+]
+OPENERS_TWO = [
+    "{a} meets {b} in this piece.",
+    "Featuring {a} with {b}.",
+    "{a}, finished with {b}.",
+]
+MIDDLES_ONE = [
+    "Perfect for {a}.",
+    "A thoughtful pick for {a}.",
+    "Ideal as {a}.",
+]
+MIDDLES_TWO = [
+    "Ideal for {a} and {b}.",
+    "Great as {a} or {b}.",
+    "A fit for {a} and {b} alike.",
+]
+CLOSERS_ONE = [
+    "Add {a} to your collection today.",
+    "A standout choice for {a}.",
+    "Made for {a}.",
+]
+CLOSERS_NONE = [
+    "A simple way to make it your own.",
+    "Made to be enjoyed every day.",
+    "A thoughtful gift for someone special.",
+]
+
+# How many phrases each sentence takes, by number of phrases available
+_PLANS = {
+    1: [("opener", 1), ("closer", 0)],
+    2: [("opener", 2), ("closer", 0)],
+    3: [("opener", 2), ("closer", 1)],
+    4: [("opener", 2), ("middle", 2), ("closer", 0)],
+    5: [("opener", 2), ("middle", 2), ("closer", 1)],
+    6: [("opener", 2), ("middle", 1), ("middle", 2), ("closer", 1)],
+}
+_TEMPLATES = {
+    ("opener", 1): OPENERS_ONE,
+    ("opener", 2): OPENERS_TWO,
+    ("middle", 1): MIDDLES_ONE,
+    ("middle", 2): MIDDLES_TWO,
+    ("closer", 0): CLOSERS_NONE,
+    ("closer", 1): CLOSERS_ONE,
+}
+
+
+def _head_noun(phrase: str) -> str:
+    # last word, crudely singularized: "Dad Shirts" and "Graphic Shirt" share "shirt"
+    words = re.findall(r"[a-z0-9']+", phrase.lower())
+    if not words:
+        return ""
+    word = words[-1]
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def pick_phrases(safe_phrases: Sequence[str], limit: int = MAX_PHRASES) -> List[str]:
+    """
+    Up to `limit` phrases in the given order, skipping duplicates and phrases
+    whose head noun was already used. With a single distinct head noun this
+    returns one phrase, and the one-phrase plan is used.
+    """
+    seen, nouns = set(), set()
+    picked: List[str] = []
+    for p in (p.strip() for p in safe_phrases if p and p.strip()):
+        key = p.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        noun = _head_noun(p)
+        if noun in nouns:
+            continue
+        nouns.add(noun)
+        picked.append(p)
+        if len(picked) == limit:
+            return picked
+    return picked
+
+
+def compose_from_templates(title: str, safe_phrases: Sequence[str]) -> str:
+    """2–4 sentence description from safe phrases; the title alone when there are none."""
+    phrases = pick_phrases(safe_phrases)
+    if not phrases:
+        return (title or "").strip()
+
+    # stable per input, so a listing keeps its wording across calls
+    variant = zlib.crc32("\n".join([title or "", *phrases]).encode("utf-8"))
+    sentences, i = [], 0
+    for n, (slot, take) in enumerate(_PLANS[len(phrases)]):
+        options = _TEMPLATES[(slot, take)]
+        template = options[(variant + n) % len(options)]
+        args = dict(zip("ab", phrases[i:i + take]))
+        i += take
+        sentence = template.format(**args)
+        sentences.append(sentence[0].upper() + sentence[1:])
+    return " ".join(sentences)
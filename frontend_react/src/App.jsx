@@ -266,13 +266,17 @@ const ImagePage = () => {
     const formData = new FormData()
     formData.append('nice_class', analysis.niceClass || '0')
     formData.append('product_text', analysis.text)
+    formData.append('title', analysis.text?.slice(0, 160) || '')
     formData.append('image_file', selectedFile)
 
     try {
-      const response = await fetch(`${API_BASE}/tags/generate`, {
-        method: 'POST',
-        body: formData,
-      })
+      const response = await fetch(
+        `${API_BASE}/tags/generate-with-description`,
+        {
+          method: 'POST',
+          body: formData,
+        },
+      )
 
       if (!response.ok) {
         const errorText = await response.text()
@@ -281,30 +285,7 @@ const ImagePage = () => {
 
       const data = await response.json()
       const tagList = data?.tags || []
-
-      let generatedDescription = ''
-      if (tagList.length) {
-        try {
-          const descResponse = await fetch(
-            `${API_BASE}/compose/safe-description`,
-            {
-              method: 'POST',
-              headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({
-                safe_phrases: tagList,
-                title: analysis.text?.slice(0, 160) || '',
-              }),
-            },
-          )
-          if (descResponse.ok) {
-            const descData = await descResponse.json()
-            generatedDescription =
-              descData?.safe_listing_description?.trim() || ''
-          }
-        } catch (descError) {
-          console.error('Description generation failed', descError)
-        }
-      }
+      const generatedDescription = data?.safe_listing_description?.trim() || ''
 
       setCheckState({
         tags: tagList,
@@ -470,12 +451,16 @@ const TextPage = () => {
     const formData = new FormData()
     formData.append('nice_class', analysis.niceClass || '0')
     formData.append('product_text', analysis.text)
+    formData.append('title', analysis.text?.slice(0, 160) || '')
 
     try {
-      const response = await fetch(`${API_BASE}/tags/generate`, {
-        method: 'POST',
-        body: formData,
-      })
+      const response = await fetch(
+        `${API_BASE}/tags/generate-with-description`,
+        {
+          method: 'POST',
+          body: formData,
+        },
+      )
 
       if (!response.ok) {
         const errorText = await response.text()
@@ -484,30 +469,7 @@ const TextPage = () => {
 
       const data = await response.json()
       const tagList = data?.tags || []
-
-      let generatedDescription = ''
-      if (tagList.length) {
-        try {
-          const descResponse = await fetch(
-            `${API_BASE}/compose/safe-description`,
-            {
-              method: 'POST',
-              headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({
-                safe_phrases: tagList,
-                title: analysis.text?.slice(0, 160) || '',
-              }),
-            },
-          )
-          if (descResponse.ok) {
-            const descData = await descResponse.json()
-            generatedDescription =
-              descData?.safe_listing_description?.trim() || ''
-          }
-        } catch (descError) {
-          console.error('Description generation failed', descError)
-        }
-      }
+      const generatedDescription = data?.safe_listing_description?.trim() || ''
 
       setCheckState({
         tags: tagList,
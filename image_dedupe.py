@@ -0,0 +1,185 @@
+# image_dedupe.py
+import io
+import json
+import time
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+from cache_store import get_db
+from config import CACHE_ENABLED, IMAGE_DEDUPE_MAX_DISTANCE, IMAGE_DEDUPE_TTL
+from uploads import ImageUpload
+from tracing import span
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hash (
+    id INTEGER PRIMARY KEY,
+    dhash INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    nice_class INTEGER NOT NULL,
+    text_key TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    created_at REAL NOT NULL
+)
+"""
+
+HASH_SIZE = 8           # 8x8 = 64-bit hashes
+PHASH_SIZE = 32         # pHash: DCT of a 32x32 thumbnail, keep the lowest 8x8 frequencies
+REFRESH_EVERY = 2.0     # seconds between checks for rows added by other workers
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    m[0] /= np.sqrt(2)
+    return m
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+_BITS = 1 << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)
+
+
+def _pack(bits: np.ndarray) -> int:
+    # 64 booleans -> int64 (SQLite INTEGER is signed)
+    return int(np.bitwise_or.reduce(_BITS[bits.ravel()]).astype(np.uint64).view(np.int64))
+
+
+def image_hashes(image: Image.Image | ImageUpload) -> Tuple[int, int]:
+    """
+    (dHash, pHash) of an image as signed 64-bit ints. Both survive resizing,
+    re-encoding and light edits (text tweaks, colour shifts); dHash follows
+    brightness gradients, pHash the low-frequency structure. Decodes pixels,
+    so call it off the event loop.
+    """
+    if isinstance(image, ImageUpload):
+        # fresh handle so the shared lazy image is left untouched
+        img = Image.open(io.BytesIO(image.data))
+        img.draft("L", (PHASH_SIZE * 2, PHASH_SIZE * 2))  # JPEG: decode at reduced scale
+    else:
+        img = image
+    gray = img.convert("L")
+
+    small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    dhash = _pack(small[:, 1:] > small[:, :-1])
+
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # median without the DC term, which only tracks overall brightness
+    phash = _pack(low > np.median(low[1:]))
+    return dhash, phash
+
+
+def _text_key(product_text: str) -> str:
+    # the tag prompt includes the product text, so results are only shared for the same text
+    return " ".join((product_text or "").lower().split())
+
+
+class ImageHashIndex:
+    """
+    Perceptual hashes of images that went through tag generation, stored
+    with the tags they produced. Rows live in the shared SQLite file so every
+    worker can reuse the others' results; each process keeps the hashes in
+    numpy arrays and finds near duplicates with one XOR + popcount pass.
+    A match needs both hashes within IMAGE_DEDUPE_MAX_DISTANCE bits, the same
+    Nice class and the same product text.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dhash = np.zeros(0, dtype=np.int64)
+        self._phash = np.zeros(0, dtype=np.int64)
+        self._classes = np.zeros(0, dtype=np.int32)
+        self._created = np.zeros(0, dtype=np.float64)
+        self._text_keys: List[str] = []
+        self._tags: List[List[str]] = []
+        self._last_id = 0
+        self._last_refresh = 0.0
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_db()
+        conn.execute(_SCHEMA)
+        return conn
+
+    def _refresh(self, force: bool = False) -> None:
+        if not CACHE_ENABLED:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_refresh < REFRESH_EVERY:
+            return
+        self._last_refresh = now
+        try:
+            conn = self._db()
+            if self._last_id == 0:
+                # first load: drop what has expired meanwhile
+                conn.execute("DELETE FROM image_hash WHERE created_at < ?", (time.time() - IMAGE_DEDUPE_TTL,))
+            rows = conn.execute(
+                "SELECT id, dhash, phash, nice_class, text_key, tags, created_at FROM image_hash WHERE id > ? ORDER BY id",
+                (self._last_id,),
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"image_hash refresh failed: {e}")
+            return
+        if not rows:
+            return
+        self._dhash = np.concatenate([self._dhash, np.array([r[1] for r in rows], dtype=np.int64)])
+        self._phash = np.concatenate([self._phash, np.array([r[2] for r in rows], dtype=np.int64)])
+        self._classes = np.concatenate([self._classes, np.array([r[3] for r in rows], dtype=np.int32)])
+        self._created = np.concatenate([self._created, np.array([r[6] for r in rows], dtype=np.float64)])
+        self._text_keys.extend(r[4] for r in rows)
+        self._tags.extend(json.loads(r[5]) for r in rows)
+        self._last_id = rows[-1][0]
+
+    def refresh(self) -> None:
+        """Load rows added since the last refresh (by any worker)."""
+        with self._lock:
+            self._refresh(force=True)
+
+    def find(self, hashes: Tuple[int, int], nice_class: int, product_text: str, max_distance: int = IMAGE_DEDUPE_MAX_DISTANCE) -> Optional[List[str]]:
+        """Tags of the closest stored near-duplicate, or None."""
+        with span("image_dedupe.find") as s:
+            tags = self._find(hashes, nice_class, product_text, max_distance)
+            s.set(hit=tags is not None)
+        return tags
+
+    def _find(self, hashes: Tuple[int, int], nice_class: int, product_text: str, max_distance: int) -> Optional[List[str]]:
+        with self._lock:
+            self._refresh()
+            if not self._tags:
+                return None
+            dist = np.maximum(
+                np.bitwise_count((self._dhash ^ np.int64(hashes[0])).view(np.uint64)),
+                np.bitwise_count((self._phash ^ np.int64(hashes[1])).view(np.uint64)),
+            ).astype(np.int32)
+            ok = (dist <= max_distance) & (self._classes == nice_class) & (self._created >= time.time() - IMAGE_DEDUPE_TTL)
+            key = _text_key(product_text)
+            # closest first, newest on ties
+            for i in sorted(np.flatnonzero(ok), key=lambda i: (dist[i], -i)):
+                if self._text_keys[i] == key:
+                    print(f"DEBUG: image near-duplicate (distance {dist[i]}), reusing {len(self._tags[i])} tags")
+                    return list(self._tags[i])
+            return None
+
+    def add(self, hashes: Tuple[int, int], nice_class: int, product_text: str, tags: List[str]) -> None:
+        """Record the tags generated for an image."""
+        if not CACHE_ENABLED or not tags:
+            return
+        try:
+            conn = self._db()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "INSERT INTO image_hash (dhash, phash, nice_class, text_key, tags, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (hashes[0], hashes[1], int(nice_class), _text_key(product_text), json.dumps(tags), time.time()),
+                )
+        except sqlite3.Error as e:
+            print(f"image_hash add failed: {e}")
+            return
+        self.refresh()  # so this worker matches it right away
+
+
+image_index = ImageHashIndex()
@@ -0,0 +1,87 @@
+# llm_batcher.py
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into one upstream call.
+
+    submit() parks the caller; pending items are flushed after `window`
+    seconds (or as soon as `max_batch` are waiting) and handed to
+    run_batch(items) in a worker thread. run_batch returns one result per
+    item, or None for items it couldn't answer (e.g. missing from the
+    model's JSON); those, and every item of a batch whose call raised,
+    go through fallback(item) individually. Identical items in a window
+    share one slot.
+
+    With `partition`, items are only batched with others that returned the
+    same partition() value when submitted (e.g. the same tenant, so usage is
+    billed to the right caller); each batch runs in the context of one of
+    its own submitters.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Hashable]], List[Optional[Any]]],
+        fallback: Callable[[Hashable], Awaitable[Any]],
+        window: float,
+        max_batch: int,
+        partition: Optional[Callable[[], Hashable]] = None,
+    ):
+        self._run_batch = run_batch
+        self._fallback = fallback
+        self._window = window
+        self._max_batch = max_batch
+        self._partition = partition
+        self._pending: Dict[Hashable, Dict[Hashable, List[asyncio.Future]]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item: Hashable) -> Any:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        part = self._partition() if self._partition is not None else None
+        pending = self._pending.setdefault(part, {})
+        pending.setdefault(item, []).append(fut)
+        if len(pending) >= self._max_batch:
+            self._flush(part)
+        elif part not in self._timers:
+            # call_later runs _flush in this submitter's context
+            self._timers[part] = loop.call_later(self._window, self._flush, part)
+        return await fut
+
+    def _flush(self, part: Hashable) -> None:
+        timer = self._timers.pop(part, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(part, {})
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[Hashable, List[asyncio.Future]]) -> None:
+        items = list(batch)
+        try:
+            results = await asyncio.to_thread(self._run_batch, items)
+        except Exception as e:
+            print(f"Batched LLM call for {len(items)} items failed ({e}), falling back per item")
+            results = [None] * len(items)
+
+        async def settle(item: Hashable, result: Optional[Any]) -> None:
+            try:
+                if result is None:
+                    result = await self._fallback(item)
+                outcome: Tuple[bool, Any] = (True, result)
+            except Exception as e:
+                outcome = (False, e)
+            for fut in batch[item]:
+                if fut.done():
+                    continue
+                if outcome[0]:
+                    fut.set_result(outcome[1])
+                else:
+                    fut.set_exception(outcome[1])
+
+        await asyncio.gather(*(settle(i, r) for i, r in zip(items, results)))
@@ -0,0 +1,145 @@
+# llm_cache.py
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import LLM_CACHE_TTL, LLM_CACHE_MAX_ITEMS
+from cache_store import SharedCache, make_key
+from tracing import span
+
+# Seconds between writes of accumulated per-entry hit counts
+HIT_FLUSH_INTERVAL = 10.0
+
+
+def usage_of(response) -> Dict[str, int]:
+    """Token counts from a Gemini response's usage_metadata (zeros if absent)."""
+    meta = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_tokens": int(getattr(meta, "prompt_token_count", 0) or 0),
+        "output_tokens": int(getattr(meta, "candidates_token_count", 0) or 0),
+        "total_tokens": int(getattr(meta, "total_token_count", 0) or 0),
+    }
+
+
+class ResponseCache:
+    """
+    Two-level cache for text-generation responses: an in-process LRU in
+    front of the shared on-disk store. Each entry keeps the token cost of
+    the call that produced it and how many times it has been reused, so
+    saved tokens can be accounted per entry. Hits are counted in memory and
+    added to the stored entries in batches (every HIT_FLUSH_INTERVAL); a
+    read never rewrites the entry.
+    """
+
+    def __init__(self, namespace: str = "llm", max_items: int = LLM_CACHE_MAX_ITEMS, ttl: Optional[float] = LLM_CACHE_TTL):
+        self._disk = SharedCache(namespace, ttl=ttl)
+        self._lru: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._max_items = max_items
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._pending_hits: Dict[str, int] = {}
+        self._last_flush = time.monotonic()
+
+    def _remember(self, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._lru[key] = entry
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._max_items:
+                self._lru.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with span("llm_cache.get") as s:
+            entry = self._get(key)
+            s.set(hit=entry is not None)
+        return entry
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+        if entry is None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += entry.get("usage", {}).get("total_tokens", 0)
+            self._pending_hits[key] = self._pending_hits.get(key, 0) + 1
+            due = time.monotonic() - self._last_flush >= HIT_FLUSH_INTERVAL
+        if due:
+            self.flush_hits()
+        return entry
+
+    def flush_hits(self) -> None:
+        """Add the hits counted since the last flush to the stored entries."""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+            self._last_flush = time.monotonic()
+        self._disk.increment(pending, "hits")
+
+    def put(self, key: str, text: str, usage: Dict[str, int]) -> None:
+        entry = {"text": text, "usage": usage, "hits": 0}
+        self._remember(key, entry)
+        self._disk.set(key, entry)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "tokens_saved": self.tokens_saved,
+            "memory_entries": len(self._lru),
+        }
+
+
+response_cache = ResponseCache()
+atexit.register(response_cache.flush_hits)
+
+
+def generation_key(model_id: str, prompt_version: str, cache_input: Any, generation_config: Dict[str, Any]) -> str:
+    return make_key(model_id, prompt_version, cache_input, generation_config)
+
+
+def cached_generate(
+    model,
+    model_id: str,
+    prompt_version: str,
+    cache_input: Any,
+    prompt,
+    generation_config: Dict[str, Any],
+    use_cache: bool = True,
+) -> str:
+    """
+    Call model.generate_content(prompt) through the response cache.
+
+    The key is (model_id, prompt_version, cache_input, generation_config):
+    cache_input should be the normalized values the prompt was built from and
+    prompt_version must be bumped whenever the template changes. Callers may
+    bypass the cache (use_cache=False) only for non-zero temperatures;
+    deterministic calls are always served from cache when possible, as is
+    everything once the tenant's LLM budget is spent.
+    Empty responses are never cached.
+    """
+    from usage_meter import meter  # usage_meter imports usage_of from here
+
+    deterministic = not generation_config.get("temperature")
+    lookup = use_cache or deterministic or meter.over_budget("llm") is not None
+    key = generation_key(model_id, prompt_version, cache_input, generation_config)
+
+    if lookup:
+        entry = response_cache.get(key)
+        if entry is not None:
+            return entry["text"]
+
+    response = model.generate_content(prompt, generation_config=generation_config)
+    text = response.text or ""
+    if text.strip():
+        response_cache.put(key, text, usage_of(response))
+    return text
@@ -1,10 +1,14 @@
 from dotenv import load_dotenv
 load_dotenv() 
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 
 from ranking_api import router as ranking_router
 from parser_and_classifier_api import router as parser_router
@@ -12,14 +16,49 @@ from tag_generator_api import router as tag_generator_router
 from aggregator_api import router as aggregator_router
 from tmcheck_api import router as tmcheck_router
 
+from config import MAX_UPLOAD_BYTES, PROFILING_ENABLED, TRACING_ENABLED, BLOCKING_THREADS
+from profiling import router as profiling_router, profile_requests
+from tracing import router as tracing_router, trace_requests, exporter as trace_exporter
+from usage_meter import router as usage_router, assign_tenant, meter
+from scheduler import router as scheduler_router, assign_traffic_class
+from warmup import warm_up, warmup_state
+import uspto_client
+
 import os
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # threads parked on an upstream slot must not exhaust the pool (see BLOCKING_THREADS)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="blocking")
+    )
+    # uvicorn only starts accepting connections once this returns
+    await warm_up()
+    yield
+    await uspto_client.close_client()
+    await asyncio.to_thread(meter.flush)
+    await asyncio.to_thread(trace_exporter.flush)
+
 app = FastAPI(
     title="TradeMark Checker API",
-    description="An API suite for product classification, tag generation, and trademark analysis."
+    description="An API suite for product classification, tag generation, and trademark analysis.",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
-# Add CORS middleware to allow frontend access
+# Slack for multipart boundaries and the non-file form fields
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # Refuse before any of the body is read when the declared length is already too big
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse(status_code=413, content={"detail": f"Request body larger than {MAX_UPLOAD_BYTES} bytes"})
+    return await call_next(request)
+
+# Add CORS middleware to allow frontend access. Registered after the size
+# check so it wraps it and the 413 carries the CORS headers.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
@@ -27,9 +66,24 @@ app.add_middleware(
     allow_methods=["*"],  
     allow_headers=["*"],  
 )
+
+app.middleware("http")(assign_tenant)
+app.middleware("http")(assign_traffic_class)
+
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_requests)
+    app.include_router(profiling_router)
+
+if TRACING_ENABLED:
+    app.middleware("http")(trace_requests)
+    app.include_router(tracing_router)
+
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    warmup = {"duration_ms": warmup_state["duration_ms"], "steps": warmup_state["steps"]}
+    if not warmup_state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "warming_up", "warmup": warmup})
+    return {"status": "ok", "warmup": warmup}
 
 
 # Include all API routers
@@ -38,3 +92,5 @@ app.include_router(ranking_router)
 app.include_router(parser_router)
 app.include_router(aggregator_router)
 app.include_router(tmcheck_router)
+app.include_router(usage_router)
+app.include_router(scheduler_router)
@@ -1,12 +1,14 @@
 # parser_api.py
-import os, json, re
-from typing import Optional
+import os, json, re, time, asyncio, hashlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from pydantic import BaseModel
-from config import MODEL_ID, get_model
-
-# Base model used for OCR + classification
-model = get_model(MODEL_ID)
+from config import (
+    MODEL_ID, PARSE_CACHE_TTL, get_model,
+    PARSE_IMAGE_TIERS, PARSE_IMAGE_MIN_CONFIDENCE, PARSE_TEXT_TIERS, PARSE_TEXT_MIN_CONFIDENCE,
+)
+from cache_store import SharedCache, make_key
+from uploads import ImageUpload, read_image_upload
 
 SYSTEM_INSTRUCTIONS = (
     "You are a vision assistant. Extract readable text from the image and "
@@ -55,12 +57,7 @@ GENERATION_CONFIG = {
     "temperature": 0.2,
 }
 
-# Vision model with system instructions for OCR + classification
-model = get_model(
-    MODEL_ID,
-    system_instruction=SYSTEM_INSTRUCTIONS,
-)
-
+# OCR + classification models are built per tier (see _generate_tiered)
 PROMPT_TEMPLATE = f"""
 Task:
 1) Read *all* visible text (OCR).
@@ -82,12 +79,112 @@ Output strictly as JSON with this schema:
 }}
 """
 
+# Cheap first-tier variant: same output schema, no guidance
+MINIMAL_PROMPT_TEMPLATE = f"""
+Read all visible text in the image and pick the object it is on from: {"; ".join(OBJECT_TYPE_HINTS)}.
+JSON: {{"text": "...", "object_type": "one item from the list", "confidence": 0.0 to 1.0, "notes": ""}}
+"""
+
+IMAGE_PROMPTS = {"full": PROMPT_TEMPLATE, "minimal": MINIMAL_PROMPT_TEMPLATE}
+
 router = APIRouter(prefix="/parser", tags=["parser"])
 
+# Parse results shared across workers, keyed by model + prompt + input.
+_parse_cache = SharedCache("parse", ttl=PARSE_CACHE_TTL)
+
 
 class TextParseRequest(BaseModel):
     description: str
 
+
+def _cache_value(out: dict) -> dict:
+    # attempts are this call's timings; a later hit must not report them as its own
+    return {**out, "meta": {k: v for k, v in out["meta"].items() if k != "attempts"}}
+
+
+def _cached_response(cached: dict) -> dict:
+    meta = {k: v for k, v in cached.get("meta", {}).items() if k != "attempts"}
+    return {**cached, "meta": {**meta, "cached": True}}
+
+
+# --- Tiered inference ---
+
+_tier_models: Dict[Tuple[str, Optional[str]], Any] = {}
+
+
+def _tier_model(model_id: str, system_instruction: Optional[str] = None):
+    key = (model_id, system_instruction)
+    if key not in _tier_models:
+        kwargs = {"system_instruction": system_instruction} if system_instruction else {}
+        _tier_models[key] = get_model(model_id, **kwargs)
+    return _tier_models[key]
+
+
+def _confidence(data: dict) -> float:
+    try:
+        return float(data.get("confidence") or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def _generate_tiered(
+    tiers: List[dict],
+    min_confidence: float,
+    contents_for: Callable[[dict], Awaitable[Any]],
+    valid: Callable[[dict], bool],
+    system_instruction: Optional[str] = None,
+) -> Tuple[dict, dict, List[dict]]:
+    """
+    Run the tiers cheapest first and stop at the first answer that is valid
+    JSON (and passes `valid`) with confidence >= min_confidence. If no tier
+    clears the bar, the most confident valid answer wins.
+
+    Returns (data, answering tier, attempts) where attempts records each
+    tier tried with its confidence or failure and latency.
+    """
+    attempts: List[dict] = []
+    best: Optional[Tuple[float, dict, dict]] = None
+    last_error = "no parse tiers configured"
+    for tier in tiers:
+        started = time.perf_counter()
+        attempt: Dict[str, Any] = {"tier": tier["name"], "model": tier["model"]}
+        attempts.append(attempt)
+        try:
+            contents = await contents_for(tier)
+            resp = await asyncio.to_thread(
+                _tier_model(tier["model"], system_instruction).generate_content,
+                contents,
+                generation_config=GENERATION_CONFIG,
+                safety_settings=None,
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            last_error = f"LLM call failed: {e}"
+            attempt.update(error="llm_call_failed", ms=round((time.perf_counter() - started) * 1000))
+            continue
+        attempt["ms"] = round((time.perf_counter() - started) * 1000)
+
+        try:
+            data = json.loads(resp.text)
+            if not isinstance(data, dict) or not valid(data):
+                raise ValueError("Model returned unusable JSON")
+        except Exception:
+            last_error = f"Non-JSON model response: {resp.text!r}"
+            attempt["error"] = "invalid_json"
+            continue
+
+        confidence = _confidence(data)
+        attempt["confidence"] = confidence
+        if best is None or confidence > best[0]:
+            best = (confidence, data, tier)
+        if confidence >= min_confidence:
+            break
+
+    if best is None:
+        raise HTTPException(status_code=502, detail=last_error)
+    return best[1], best[2], attempts
+
 # Accepts an image file and returns text + Nice class as JSON.
 @router.post("/v1/parse-image")
 async def parse_image(image: UploadFile = File(...)):
@@ -95,32 +192,30 @@ async def parse_image(image: UploadFile = File(...)):
     if not content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail=f"Unsupported content type: {content_type}")
 
-    img_bytes = await image.read()
-    if not img_bytes:
-        raise HTTPException(status_code=400, detail="Empty image file")
-
-    parts = [
-        PROMPT_TEMPLATE,
-        {"mime_type": content_type, "data": img_bytes},
-    ]
-
-    # First: OCR + object classification
-    try:
-        resp = model.generate_content(
-            parts,
-            generation_config=GENERATION_CONFIG,
-            safety_settings=None,
-        )
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"LLM call failed: {e}")
+    upload = await read_image_upload(image)
+    img_bytes = upload.data
+    content_type = upload.content_type
 
-    # Parse JSON from the model
-    try:
-        data = json.loads(resp.text)
-        if not isinstance(data, dict):
-            raise ValueError("Model returned non-dict JSON")
-    except Exception:
-        raise HTTPException(status_code=502, detail=f"Non-JSON model response: {resp.text!r}")
+    cache_key = make_key(
+        "image", PARSE_IMAGE_TIERS, PARSE_IMAGE_MIN_CONFIDENCE, IMAGE_PROMPTS, hashlib.sha256(img_bytes).hexdigest()
+    )
+    cached = await _parse_cache.get_async(cache_key)
+    if cached is not None:
+        return _cached_response(cached)
+
+    async def contents_for(tier: dict) -> list:
+        max_side = tier.get("max_side")
+        part = await asyncio.to_thread(upload.downscaled_part, max_side) if max_side else upload.part
+        return [IMAGE_PROMPTS[tier.get("prompt", "full")], part]
+
+    # First: OCR + object classification, cheapest tier that is confident enough
+    data, tier, attempts = await _generate_tiered(
+        PARSE_IMAGE_TIERS,
+        PARSE_IMAGE_MIN_CONFIDENCE,
+        contents_for,
+        valid=lambda d: bool(d.get("object_type")),
+        system_instruction=SYSTEM_INSTRUCTIONS,
+    )
 
     # Ensure expected keys exist
     data.setdefault("text", "")
@@ -157,7 +252,8 @@ Minimalist travel notebook for writers & artists."
 Now generate the listing description:
 """
 
-        desc_resp = desc_model.generate_content(desc_prompt)
+        # off the loop: generate_content may wait for an upstream slot (scheduler.py)
+        desc_resp = await asyncio.to_thread(desc_model.generate_content, desc_prompt)
         description = (getattr(desc_resp, "text", "") or "").strip()
     except Exception:
         # If the description generation fails, don't kill the whole endpoint
@@ -166,15 +262,22 @@ Now generate the listing description:
     # Attach the description to the result JSON
     data["description"] = description
 
-    return {
+    out = {
         "ok": True,
         "result": data,
         "meta": {
-            "model": MODEL_ID,
+            "model": tier["model"],
+            "tier": tier["name"],
+            "attempts": attempts,
+            "cached": False,
             "content_type": content_type,
             "bytes": len(img_bytes),
         },
     }
+    # Only cache complete results so a failed description gets retried next time.
+    if description:
+        await _parse_cache.set_async(cache_key, _cache_value(out))
+    return out
 
 
 TEXT_PROMPT_TEMPLATE = f"""
@@ -190,6 +293,13 @@ Respond strictly as JSON with the following schema:
 }}
 """
 
+MINIMAL_TEXT_PROMPT_TEMPLATE = f"""
+Pick the Nice class for the product described below from: {"; ".join(OBJECT_TYPE_HINTS)}.
+JSON: {{"object_type": "one item from the list", "nice_class": 0, "summary": "", "confidence": 0.0 to 1.0}}
+"""
+
+TEXT_PROMPTS = {"full": TEXT_PROMPT_TEMPLATE, "minimal": MINIMAL_TEXT_PROMPT_TEMPLATE}
+
 
 def _extract_class_from_label(label: str) -> Optional[int]:
     match = re.search(r"\b(\d{1,2})\b", label or "")
@@ -202,27 +312,27 @@ async def parse_text(payload: TextParseRequest):
     if not description:
         raise HTTPException(status_code=400, detail="description is required")
 
-    prompt = (
-        f"{TEXT_PROMPT_TEMPLATE}\n\n"
-        f"Product description:\n{description}\n"
-        "JSON:"
+    cache_key = make_key(
+        "text", PARSE_TEXT_TIERS, PARSE_TEXT_MIN_CONFIDENCE, SYSTEM_INSTRUCTIONS, TEXT_PROMPTS, description
     )
-
-    try:
-        resp = model.generate_content(
-            prompt,
-            generation_config=GENERATION_CONFIG,
-            safety_settings=None,
+    cached = await _parse_cache.get_async(cache_key)
+    if cached is not None:
+        return _cached_response(cached)
+
+    async def contents_for(tier: dict) -> str:
+        return (
+            f"{TEXT_PROMPTS[tier.get('prompt', 'full')]}\n\n"
+            f"Product description:\n{description}\n"
+            "JSON:"
         )
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"LLM call failed: {e}")
 
-    try:
-        data = json.loads(resp.text)
-        if not isinstance(data, dict):
-            raise ValueError("model response not dict")
-    except Exception:
-        raise HTTPException(status_code=502, detail=f"Non-JSON model response: {resp.text!r}")
+    data, tier, attempts = await _generate_tiered(
+        PARSE_TEXT_TIERS,
+        PARSE_TEXT_MIN_CONFIDENCE,
+        contents_for,
+        valid=lambda d: (d.get("nice_class") or _extract_class_from_label(d.get("object_type", ""))) is not None,
+        system_instruction=SYSTEM_INSTRUCTIONS,
+    )
 
     object_type = data.get("object_type", "")
     nice_class = data.get("nice_class") or _extract_class_from_label(object_type)
@@ -235,10 +345,16 @@ async def parse_text(payload: TextParseRequest):
         "confidence": data.get("confidence"),
     }
 
-    return {
+    out = {
         "ok": True,
         "result": result,
         "meta": {
-            "model": MODEL_ID,
+            "model": tier["model"],
+            "tier": tier["name"],
+            "attempts": attempts,
+            "cached": False,
         },
     }
+    await _parse_cache.set_async(cache_key, _cache_value(out))
+    return out
+
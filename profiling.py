@@ -0,0 +1,311 @@
+# profiling.py
+import os
+import sys
+import json
+import time
+import uuid
+import html
+import random
+import asyncio
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse
+
+from config import PROFILE_HEADER, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_DIR, PROFILE_KEEP
+
+router = APIRouter(prefix="/debug/profiles", tags=["debug"])
+
+MAX_DEPTH = 128
+_ROOT = os.path.abspath(os.getcwd()) + os.sep
+
+# The profile of the request being handled, if it is being profiled
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("profile", default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    if path.startswith(_ROOT):
+        path = path[len(_ROOT):]
+    else:
+        path = "/".join(path.split(os.sep)[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def _is_idle_worker(frame) -> bool:
+    """True for a thread-pool thread parked on its work queue (nothing to show)."""
+    while frame is not None and frame.f_code.co_filename.endswith(("threading.py", "queue.py")):
+        frame = frame.f_back
+    return frame is not None and frame.f_code.co_name == "_worker" and frame.f_code.co_filename.endswith(os.path.join("futures", "thread.py"))
+
+
+class RequestProfile:
+    """
+    Wall-clock sampling profile of one request, py-spy style: a background
+    thread snapshots every thread's Python stack each interval, so time spent
+    waiting on upstream I/O shows up alongside CPU work (validation, image
+    decode, JSON, scoring). Samples are process-wide; concurrent requests
+    appear too. Loop-thread stacks are prefixed with the pipeline stage the
+    request was in (see mark/stage) so the flamegraph splits by stage.
+    """
+
+    def __init__(self, method: str, path: str, interval: float):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.stages: List[Dict[str, Any]] = []
+        self.section: Optional[Dict[str, Any]] = None
+        self.nested: List[str] = []
+        self.active = False
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._t0 = 0.0
+        self.created_at = 0.0
+        self.duration_ms = 0.0
+        self.status_code: Optional[int] = None
+
+    def _now_ms(self) -> float:
+        return round((time.perf_counter() - self._t0) * 1000, 2)
+
+    def start(self) -> None:
+        self.created_at = time.time()
+        self._t0 = time.perf_counter()
+        self.active = True
+        self._thread = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.mark(None)
+        self.active = False
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration_ms = self._now_ms()
+
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            section = self.section
+            stage = ";".join((["stage:" + section["name"]] if section else []) + self.nested)
+            for ident, frame in sys._current_frames().items():
+                if ident == me or names.get(ident) == "profile-sampler" or _is_idle_worker(frame):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                prefix = [names.get(ident, str(ident))]
+                if ident == self._loop_thread and stage:
+                    prefix.append(stage)
+                self.samples[";".join(prefix + stack[::-1])] += 1
+
+    def mark(self, name: Optional[str]) -> None:
+        # closes the current top-level section and opens the next one
+        if not self.active:
+            return
+        now = self._now_ms()
+        if self.section is not None:
+            self.section["end_ms"] = now
+        self.section = None
+        if name is not None:
+            self.section = {"name": name, "start_ms": now, "end_ms": None}
+            self.stages.append(self.section)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "created_at": self.created_at,
+            "duration_ms": self.duration_ms,
+            "interval_ms": self.interval * 1000,
+            "sample_count": sum(self.samples.values()),
+            "stages": self.stages,
+            "folded": dict(self.samples.most_common()),
+        }
+
+
+def mark(name: str) -> None:
+    """Annotate the profiled request as having entered a named pipeline stage."""
+    profile = _current.get()
+    if profile is not None:
+        profile.mark(name)
+
+
+@contextmanager
+def stage(name: str):
+    """Nested stage annotation; a no-op unless the request is being profiled."""
+    profile = _current.get()
+    if profile is None or not profile.active:
+        yield
+        return
+    entry = {"name": ";".join(profile.nested + [name]), "start_ms": profile._now_ms(), "end_ms": None}
+    profile.stages.append(entry)
+    profile.nested.append(name)
+    try:
+        yield
+    finally:
+        profile.nested.remove(name)
+        entry["end_ms"] = profile._now_ms()
+
+
+# --- storage ---
+
+def _path(profile_id: str) -> str:
+    if not profile_id.isalnum():
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    return os.path.join(PROFILE_DIR, profile_id + ".json")
+
+
+def _save(data: Dict[str, Any]) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp = _path(data["id"]) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, _path(data["id"]))
+    # keep only the newest PROFILE_KEEP captures
+    files = sorted(
+        (os.path.join(PROFILE_DIR, n) for n in os.listdir(PROFILE_DIR) if n.endswith(".json")),
+        key=os.path.getmtime,
+    )
+    for old in files[:-PROFILE_KEEP]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+
+def _load(profile_id: str) -> Dict[str, Any]:
+    try:
+        with open(_path(profile_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=404, detail="Unknown profile")
+
+
+# --- middleware ---
+
+def _wants_profile(request: Request) -> bool:
+    if request.url.path.startswith(router.prefix):
+        return False
+    if request.headers.get(PROFILE_HEADER, "").lower() in {"1", "true", "yes"}:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+async def profile_requests(request: Request, call_next):
+    """
+    HTTP middleware: profile requests that send `X-Profile: 1` (PROFILE_HEADER)
+    or that are picked by PROFILE_SAMPLE_RATE. The capture id is returned in
+    the X-Profile-Id response header. Streaming bodies are only profiled up to
+    the point the response starts.
+    """
+    if not _wants_profile(request):
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path, PROFILE_INTERVAL_MS / 1000)
+    token = _current.set(profile)
+    profile.start()
+    try:
+        response = await call_next(request)
+        profile.status_code = response.status_code
+    finally:
+        profile.stop()
+        _current.reset(token)
+        try:
+            await asyncio.to_thread(_save, profile.to_dict())
+        except OSError as e:
+            print(f"profile {profile.id} not saved: {e}")
+    response.headers["X-Profile-Id"] = profile.id
+    return response
+
+
+# --- debug endpoints ---
+
+def _build_tree(folded: Dict[str, int]) -> Dict[str, Any]:
+    root: Dict[str, Any] = {"name": "all", "value": 0, "children": {}}
+    for stack, count in folded.items():
+        node = root
+        node["value"] += count
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"name": name, "value": 0, "children": {}})
+            node["value"] += count
+    return root
+
+
+def _render(node: Dict[str, Any], total: int, parent_value: int, min_share: float = 0.002) -> str:
+    children = "".join(
+        _render(child, total, node["value"], min_share)
+        for child in sorted(node["children"].values(), key=lambda c: -c["value"])
+        if child["value"] / total >= min_share
+    )
+    label = html.escape(node["name"])
+    width = node["value"] * 100 / parent_value
+    return (
+        f'<div class="n" style="width:{width:.3f}%">'
+        f'<div class="f" title="{label} ({node["value"]} samples, {node["value"] / total:.1%})">{label}</div>'
+        f'<div class="c">{children}</div></div>'
+    )
+
+
+@router.get("")
+def list_profiles():
+    """Newest captures first, without their samples."""
+    out = []
+    if os.path.isdir(PROFILE_DIR):
+        for name in os.listdir(PROFILE_DIR):
+            if name.endswith(".json"):
+                try:
+                    data = _load(name[:-5])
+                except HTTPException:
+                    continue
+                data.pop("folded", None)
+                out.append(data)
+    return sorted(out, key=lambda d: d["created_at"], reverse=True)
+
+
+@router.get("/{profile_id}")
+def get_profile(profile_id: str):
+    return _load(profile_id)
+
+
+@router.get("/{profile_id}/folded", response_class=PlainTextResponse)
+def get_profile_folded(profile_id: str):
+    """Collapsed stacks, one per line, for flamegraph.pl or speedscope."""
+    data = _load(profile_id)
+    return "\n".join(f"{stack} {count}" for stack, count in data["folded"].items())
+
+
+@router.get("/{profile_id}/flamegraph", response_class=HTMLResponse)
+def get_profile_flamegraph(profile_id: str):
+    data = _load(profile_id)
+    tree = _build_tree(data["folded"])
+    total = max(tree["value"], 1)
+    stages = "".join(
+        f"<tr><td>{html.escape(s['name'])}</td><td>{s['start_ms']}</td><td>{s['end_ms']}</td></tr>"
+        for s in data["stages"]
+    )
+    return f"""<!doctype html>
+<html><head><meta charset="utf-8"><title>{html.escape(data['method'])} {html.escape(data['path'])}</title>
+<style>
+body {{ font: 12px monospace; margin: 1em; }}
+.n {{ display: flex; flex-direction: column; }}
+.c {{ display: flex; }}
+.f {{ background: #f4a460; border: 1px solid #fff; overflow: hidden; white-space: nowrap; padding: 1px 2px; }}
+.f:hover {{ background: #e9967a; }}
+td {{ padding: 0 1em 0 0; }}
+</style></head><body>
+<h3>{html.escape(data['method'])} {html.escape(data['path'])} — {data['duration_ms']} ms, {data['sample_count']} samples every {data['interval_ms']} ms</h3>
+<table><tr><th>stage</th><th>start ms</th><th>end ms</th></tr>{stages}</table><br>
+{_render(tree, total, total)}
+</body></html>"""
@@ -1,50 +1,189 @@
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field
-from typing import List
-import math
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
 import asyncio
-from config import MODEL_ID, EMB_MODEL_ID, get_model
-from services_embed import embed_texts
+import numpy as np
+from config import MODEL_ID, EMB_MODEL_ID, ANCHOR_TTL, get_model
+from services_embed import embed_matrix
+from cache_store import SharedCache, make_key
+from usage_meter import BudgetExceeded
+from tracing import span
 
 router = APIRouter(prefix="/ranking", tags=["ranking"])
 
 client = get_model(MODEL_ID)
 
+# anchor_id -> embedding, shared across workers so a handle works on any of them
+_anchors = SharedCache("anchor", ttl=ANCHOR_TTL)
+
 class RankRequest(BaseModel):
-    user_text: str = Field(..., description="User's product text / description")
+    user_text: str = Field("", description="User's product text / description")
     phrases: List[str] = Field(..., description="Candidate phrases to reorder")
+    anchor_vector: Optional[List[float]] = Field(None, description="Precomputed embedding to rank against instead of embedding user_text")
+    anchor_id: Optional[str] = Field(None, description="Handle from /ranking/anchor to rank against instead of embedding user_text")
+    k: int = Field(20, ge=1, le=200, description="Number of phrases to return")
+    diversity: float = Field(0.0, ge=0.0, le=1.0, description="MMR diversity weight; 0 = pure relevance, higher penalizes near-duplicates")
+
+    @model_validator(mode="after")
+    def _needs_anchor(self):
+        if not self.user_text.strip() and self.anchor_vector is None and self.anchor_id is None:
+            raise ValueError("one of user_text, anchor_vector or anchor_id is required")
+        return self
+
+class RankManyRequest(BaseModel):
+    items: List[RankRequest] = Field(..., description="Phrase lists, each with its own anchor")
+
+class AnchorRequest(BaseModel):
+    text: str = Field(..., description="Anchor text to embed once and reuse")
 
-def _cosine(a, b) -> float:
-    dot = sum(x*y for x, y in zip(a, b))
-    na = math.sqrt(sum(x*x for x in a)) + 1e-9
-    nb = math.sqrt(sum(y*y for y in b)) + 1e-9
-    return dot / (na * nb)
+class AnchorResponse(BaseModel):
+    anchor_id: str
+    dim: int
 
-async def _embed(texts: List[str]) -> list[list[float]]:
+def _unit_rows(vectors) -> np.ndarray:
+    m = np.asarray(vectors, dtype=np.float64)
+    if m.ndim == 1:
+        m = m[None, :]
+    return m / (np.linalg.norm(m, axis=1, keepdims=True) + 1e-9)
+
+async def _embed(texts: List[str]) -> np.ndarray:
     # Run embedding in thread pool to avoid blocking
-    return await asyncio.to_thread(embed_texts, texts)
+    return await asyncio.to_thread(embed_matrix, texts)
 
-@router.post("/rank", response_model=List[str])
-async def rank_phrases(req: RankRequest):
-    phrases = [p.strip() for p in req.phrases if p and p.strip()]
-    if not phrases:
-        return []
-    # dedupe preserving first occurrence
+def _clean_phrases(phrases: List[str]) -> List[str]:
+    # strip empties, dedupe preserving first occurrence
     seen, uniq = set(), []
-    for p in phrases:
+    for p in (p.strip() for p in phrases if p and p.strip()):
         k = p.lower()
         if k not in seen:
             seen.add(k)
             uniq.append(p)
-    phrases = uniq
-    # Embed user text + phrases
+    return uniq
+
+def _mmr(scores: np.ndarray, vecs: np.ndarray, k: int, diversity: float) -> List[int]:
+    """
+    Maximal Marginal Relevance: greedily pick the candidate maximizing
+    (1 - diversity) * relevance - diversity * max similarity to picks so far.
+    vecs must be unit rows; one mat-vec per pick keeps it O(k * n * dim).
+    """
+    n = len(scores)
+    k = min(k, n)
+    max_sim = np.full(n, -np.inf)
+    taken = np.zeros(n, dtype=bool)
+    picks: List[int] = []
+    for _ in range(k):
+        redundancy = np.where(np.isinf(max_sim), 0.0, max_sim)
+        mmr = (1.0 - diversity) * scores - diversity * redundancy
+        mmr[taken] = -np.inf
+        i = int(np.argmax(mmr))
+        picks.append(i)
+        taken[i] = True
+        max_sim = np.maximum(max_sim, vecs @ vecs[i])
+    return picks
+
+def _top(phrases: List[str], scores: np.ndarray, k: int = 20, vecs: Optional[np.ndarray] = None, diversity: float = 0.0) -> List[str]:
+    # relevance order first (ties: shorter, then alphabetical) so MMR ties resolve the same way
+    order = sorted(range(len(phrases)), key=lambda i: (-scores[i], len(phrases[i]), phrases[i]))
+    if diversity <= 0 or vecs is None:
+        return [phrases[i] for i in order[:k]]
+    order = np.asarray(order)
+    picks = _mmr(scores[order], vecs[order], k, diversity)
+    return [phrases[order[i]] for i in picks]
+
+async def _given_anchor(req: RankRequest) -> Optional[List[float]]:
+    """Return the caller-supplied anchor vector, or None if user_text must be embedded."""
+    if req.anchor_vector is not None:
+        if not req.anchor_vector:
+            raise HTTPException(status_code=400, detail="anchor_vector is empty")
+        return req.anchor_vector
+    if req.anchor_id is not None:
+        vec = await _anchors.get_async(req.anchor_id)
+        if vec is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired anchor_id: {req.anchor_id}")
+        return vec
+    return None
+
+async def embed_anchor(text: str) -> List[float]:
+    """Embed an anchor once so several rank calls in one request can share it."""
+    with span("rank.anchor"):
+        return (await _embed([text]))[0].tolist()
+
+@router.post("/anchor", response_model=AnchorResponse)
+async def create_anchor(req: AnchorRequest):
     try:
-        embeds = await _embed([req.user_text] + phrases)
+        vec = await embed_anchor(req.text)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Embedding failed: {e}")
-    user_vec, phrase_vecs = embeds[0], embeds[1:]
-    # Score & sort
-    scored = [(phrases[i], _cosine(phrase_vecs[i], user_vec)) for i in range(len(phrases))]
-    scored.sort(key=lambda t: (-t[1], len(t[0]), t[0]))
-    scored = scored[:20]
-    return [phrase for phrase, _ in scored]
\ No newline at end of file
+    anchor_id = make_key(EMB_MODEL_ID, req.text)
+    await _anchors.set_async(anchor_id, vec)
+    return AnchorResponse(anchor_id=anchor_id, dim=len(vec))
+
+@router.post("/rank", response_model=List[str])
+async def rank_phrases(req: RankRequest):
+    with span("rank", phrases=len(req.phrases), k=req.k):
+        return await _rank_phrases(req)
+
+async def _rank_phrases(req: RankRequest) -> List[str]:
+    phrases = _clean_phrases(req.phrases)
+    if not phrases:
+        return []
+    anchor = await _given_anchor(req)
+    # Embed phrases (+ user text unless an anchor was supplied)
+    try:
+        embeds = await _embed(([req.user_text] if anchor is None else []) + phrases)
+    except BudgetExceeded:
+        # embedding budget spent: skip ranking rather than fail
+        return phrases[:req.k]
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Embedding failed: {e}")
+    if anchor is None:
+        anchor, embeds = embeds[0], embeds[1:]
+    if len(anchor) != len(embeds[0]):
+        raise HTTPException(status_code=400, detail=f"Anchor has dim {len(anchor)}, phrases have {len(embeds[0])}")
+    # Score & sort (optionally re-ranked for diversity)
+    phrase_vecs = _unit_rows(embeds)
+    scores = phrase_vecs @ _unit_rows(anchor)[0]
+    return _top(phrases, scores, k=req.k, vecs=phrase_vecs, diversity=req.diversity)
+
+@router.post("/rank-many", response_model=List[List[str]])
+async def rank_many(req: RankManyRequest):
+    """
+    Rank several phrase lists against their own anchors with one embedding
+    call and one matrix multiply. Output order matches req.items.
+    """
+    with span("rank_many", lists=len(req.items)):
+        return await _rank_many(req)
+
+async def _rank_many(req: RankManyRequest) -> List[List[str]]:
+    lists = [_clean_phrases(item.phrases) for item in req.items]
+    anchors = await asyncio.gather(*(_given_anchor(item) for item in req.items))
+
+    # Every distinct text that still needs a vector, embedded in one batch
+    index: dict[str, int] = {}
+    for item, anchor, phrases in zip(req.items, anchors, lists):
+        for t in ([item.user_text] if anchor is None else []) + phrases:
+            index.setdefault(t, len(index))
+    if not index:
+        return [[] for _ in lists]
+    try:
+        embeds = await _embed(list(index))
+    except BudgetExceeded:
+        return [phrases[:item.k] for item, phrases in zip(req.items, lists)]
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Embedding failed: {e}")
+
+    text_vecs = _unit_rows(embeds)
+    anchor_vecs = [
+        text_vecs[index[item.user_text]] if anchor is None else _unit_rows(anchor)[0]
+        for item, anchor in zip(req.items, anchors)
+    ]
+    if any(len(a) != text_vecs.shape[1] for a in anchor_vecs):
+        raise HTTPException(status_code=400, detail=f"Anchor dims must match phrase dim {text_vecs.shape[1]}")
+
+    # scores[t, j] = cosine(text t, anchor j)
+    scores = text_vecs @ np.stack(anchor_vecs).T
+    out = []
+    for j, (item, phrases) in enumerate(zip(req.items, lists)):
+        rows = [index[p] for p in phrases]
+        out.append(_top(phrases, scores[rows, j], k=item.k, vecs=text_vecs[rows], diversity=item.diversity) if phrases else [])
+    return out
@@ -0,0 +1,258 @@
+# scheduler.py
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import APIRouter, Request
+
+from config import (
+    TRAFFIC_CLASS_HEADER, TRAFFIC_CLASS_ROUTES, TRAFFIC_CLASS_WEIGHTS, UPSTREAM_RESERVED_INTERACTIVE,
+    UPSTREAM_LLM_CONCURRENCY, UPSTREAM_EMBED_CONCURRENCY, UPSTREAM_TM_CONCURRENCY,
+)
+from tracing import span
+
+router = APIRouter(prefix="/scheduler", tags=["scheduler"])
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+WAIT_SAMPLES = 1000  # recent waits kept per class for percentiles
+
+_class: contextvars.ContextVar[str] = contextvars.ContextVar("traffic_class", default=INTERACTIVE)
+
+
+def current_class() -> str:
+    return _class.get()
+
+
+@contextmanager
+def traffic_class(name: str):
+    """Schedule upstream calls made inside the block as `name` (e.g. internal batch work)."""
+    token = _class.set(name)
+    try:
+        yield
+    finally:
+        _class.reset(token)
+
+
+def class_for_request(request: Request) -> str:
+    """A known class from TRAFFIC_CLASS_HEADER, else the longest matching TRAFFIC_CLASS_ROUTES prefix."""
+    header = request.headers.get(TRAFFIC_CLASS_HEADER, "").strip().lower()
+    if header in TRAFFIC_CLASS_WEIGHTS:
+        return header
+    path = request.url.path
+    matches = [prefix for prefix in TRAFFIC_CLASS_ROUTES if path.startswith(prefix)]
+    return TRAFFIC_CLASS_ROUTES[max(matches, key=len)] if matches else INTERACTIVE
+
+
+class _Waiter:
+    __slots__ = ("cls", "enqueued", "granted", "event", "future", "loop")
+
+    def __init__(self, cls: str, future: Optional[asyncio.Future] = None, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.cls = cls
+        self.enqueued = time.perf_counter()
+        self.granted = False
+        self.event = threading.Event() if future is None else None
+        self.future = future
+        self.loop = loop
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _WaitStats:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    def add(self, ms: float) -> None:
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.recent.append(ms)
+
+    def to_dict(self) -> Dict[str, Any]:
+        recent = sorted(self.recent)
+
+        def pct(p: float) -> float:
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 2) if recent else 0.0
+
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+class UpstreamScheduler:
+    """
+    Concurrency limit for one upstream API, shared by every traffic class.
+
+    Callers wait in one FIFO per class. When a slot frees up, the class with
+    the lowest virtual pass time goes next and its pass advances by
+    1 / weight (stride scheduling), so under contention classes get slots in
+    proportion to TRAFFIC_CLASS_WEIGHTS, and a class returning from idle
+    starts at the current virtual time rather than with banked credit. The
+    last `reserved` slots are interactive-only: bulk work can never hold
+    them, so UI requests find a free slot even while an import saturates the
+    rest. Works from threads (slot) and from the event loop (slot_async).
+    """
+
+    def __init__(self, name: str, capacity: int, reserved: int):
+        self.name = name
+        self.capacity = max(1, capacity)
+        # always leave bulk at least one slot
+        self.reserved = max(0, min(reserved, self.capacity - 1))
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[_Waiter]] = {}
+        self._pass: Dict[str, float] = {}
+        self._vtime = 0.0
+        self._in_use: Counter = Counter()
+        self._waits: Dict[str, _WaitStats] = {}
+
+    # --- core (hold self._lock) ---
+
+    def _can_take(self, cls: str) -> bool:
+        busy = sum(self._in_use.values())
+        if busy >= self.capacity:
+            return False
+        if cls != INTERACTIVE and busy - self._in_use[INTERACTIVE] >= self.capacity - self.reserved:
+            return False
+        return True
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        queue = self._queues.setdefault(waiter.cls, deque())
+        if not queue:
+            self._pass[waiter.cls] = max(self._pass.get(waiter.cls, 0.0), self._vtime)
+        queue.append(waiter)
+
+    def _grant(self) -> List[_Waiter]:
+        woken = []
+        now = time.perf_counter()
+        while True:
+            ready = [cls for cls, q in self._queues.items() if q and self._can_take(cls)]
+            if not ready:
+                return woken
+            cls = min(ready, key=lambda c: self._pass[c])
+            waiter = self._queues[cls].popleft()
+            self._vtime = self._pass[cls]
+            self._pass[cls] += 1.0 / max(TRAFFIC_CLASS_WEIGHTS.get(cls, 1), 1e-6)
+            self._in_use[cls] += 1
+            waiter.granted = True
+            self._waits.setdefault(cls, _WaitStats()).add((now - waiter.enqueued) * 1000)
+            woken.append(waiter)
+
+    @staticmethod
+    def _wake(woken: List[_Waiter]) -> None:
+        for waiter in woken:
+            if waiter.future is not None:
+                waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+            else:
+                waiter.event.set()
+
+    # --- acquire / release ---
+
+    def acquire(self, cls: str) -> None:
+        """Block the calling thread until a slot is granted to `cls`."""
+        waiter = _Waiter(cls)
+        with self._lock:
+            self._enqueue(waiter)
+            woken = self._grant()
+        self._wake(woken)
+        waiter.event.wait()
+
+    async def acquire_async(self, cls: str) -> None:
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(cls, loop.create_future(), loop)
+        with self._lock:
+            self._enqueue(waiter)
+            woken = self._grant()
+        self._wake(woken)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._queues[cls].remove(waiter)
+            if granted:
+                self.release(cls)
+            raise
+
+    def release(self, cls: str) -> None:
+        with self._lock:
+            self._in_use[cls] -= 1
+            woken = self._grant()
+        self._wake(woken)
+
+    @contextmanager
+    def slot(self, cls: Optional[str] = None):
+        cls = cls or current_class()
+        with span("scheduler.wait", upstream=self.name, traffic_class=cls):
+            self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    @asynccontextmanager
+    async def slot_async(self, cls: Optional[str] = None):
+        cls = cls or current_class()
+        with span("scheduler.wait", upstream=self.name, traffic_class=cls):
+            await self.acquire_async(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = set(self._queues) | set(self._waits) | {c for c, n in self._in_use.items() if n}
+            return {
+                "capacity": self.capacity,
+                "reserved_interactive": self.reserved,
+                "classes": {
+                    cls: {
+                        "in_use": self._in_use[cls],
+                        "queued": len(self._queues.get(cls, ())),
+                        "wait": self._waits.get(cls, _WaitStats()).to_dict(),
+                    }
+                    for cls in sorted(classes)
+                },
+            }
+
+
+def _reserved(capacity: int) -> int:
+    return math.ceil(capacity * UPSTREAM_RESERVED_INTERACTIVE)
+
+
+llm_scheduler = UpstreamScheduler("llm", UPSTREAM_LLM_CONCURRENCY, _reserved(UPSTREAM_LLM_CONCURRENCY))
+embed_scheduler = UpstreamScheduler("embed", UPSTREAM_EMBED_CONCURRENCY, _reserved(UPSTREAM_EMBED_CONCURRENCY))
+tm_scheduler = UpstreamScheduler("tm", UPSTREAM_TM_CONCURRENCY, _reserved(UPSTREAM_TM_CONCURRENCY))
+
+
+# --- middleware & endpoint ---
+
+async def assign_traffic_class(request: Request, call_next):
+    """HTTP middleware: schedule the request's upstream calls under its traffic class."""
+    token = _class.set(class_for_request(request))
+    try:
+        return await call_next(request)
+    finally:
+        _class.reset(token)
+
+
+@router.get("")
+def get_scheduler_stats():
+    """Per upstream: capacity, slots in use, queue depth and queue-wait times by traffic class (this worker)."""
+    return {s.name: s.stats() for s in (llm_scheduler, embed_scheduler, tm_scheduler)}
@@ -0,0 +1,42 @@
+# serve.py
+"""
+Production launcher: runs main:app under N uvicorn worker processes that
+share one listening socket and the on-disk cache (see cache_store.py).
+
+    python serve.py
+
+Environment:
+    HOST / PORT              bind address (default 0.0.0.0:8000)
+    WEB_CONCURRENCY          explicit worker count
+    WORKERS_PER_CORE         workers per CPU core when WEB_CONCURRENCY unset (default 1)
+    MAX_WORKERS              upper bound on the computed worker count
+    GRACEFUL_TIMEOUT         seconds a stopping worker waits for in-flight requests (default 60)
+
+Graceful reload: send SIGHUP to the parent process. Workers are restarted one
+at a time; each stops accepting new connections and drains in-flight requests
+(including streaming responses) before exiting, while the remaining workers
+keep serving on the shared socket.
+"""
+import os
+import uvicorn
+
+
+def worker_count() -> int:
+    explicit = os.getenv("WEB_CONCURRENCY")
+    if explicit:
+        return max(1, int(explicit))
+    cores = os.cpu_count() or 1
+    n = max(1, int(cores * float(os.getenv("WORKERS_PER_CORE", "1"))))
+    cap = os.getenv("MAX_WORKERS")
+    return min(n, int(cap)) if cap else n
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=worker_count(),
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_TIMEOUT", "60")),
+        proxy_headers=True,
+    )
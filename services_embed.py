@@ -1,85 +1,331 @@
-from typing import List
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import google.generativeai as genai
-from config import EMB_MODEL_ID
+from google.api_core import exceptions as google_exceptions
+from config import (
+    EMB_MODEL_ID, EMBED_CACHE_TTL, EMBED_BATCH_SIZE, EMBED_PARALLELISM, EMBED_RETRIES,
+    EMBED_MEMORY_DTYPE, EMBED_MEMORY_MAX,
+)
+from cache_store import SharedCache, make_key
+from usage_meter import meter
+from tracing import span
+from scheduler import embed_scheduler
+
+_cache = SharedCache("embed", ttl=EMBED_CACHE_TTL)
+
+# Sub-batches run here; embed_texts itself is usually called via asyncio.to_thread.
+_pool = ThreadPoolExecutor(max_workers=EMBED_PARALLELISM, thread_name_prefix="embed")
+
+def _is_vector(v) -> bool:
+    return isinstance(v, list) and bool(v) and isinstance(v[0], (int, float))
+
+def _as_vector(e) -> List[float]:
+    if isinstance(e, dict):
+        e = e.get("values", e.get("embedding"))
+        if isinstance(e, dict):
+            e = e.get("values")
+    if not _is_vector(e):
+        raise ValueError("not an embedding vector")
+    return e
+
+def _as_vectors(v) -> List[List[float]]:
+    # one vector or a list of vectors
+    if _is_vector(v) or isinstance(v, dict):
+        return [_as_vector(v)]
+    return [_as_vector(e) for e in v]
+
+# Known response layouts, tried in order the first time; the one that
+# works is remembered so later calls don't have to guess.
+_LAYOUTS: List[Tuple[str, Callable[[Any], List[List[float]]]]] = [
+    ("embedding", lambda r: _as_vectors(r["embedding"])),
+    ("embeddings", lambda r: _as_vectors(r["embeddings"])),
+    ("data", lambda r: [_as_vector(d["embedding"]) for d in r["data"]]),
+    ("list", lambda r: _as_vectors(r) if isinstance(r, list) else _as_vectors(None)),
+]
+_layout: Optional[Tuple[str, Callable[[Any], List[List[float]]]]] = None
+
+def _extract(res) -> List[List[float]]:
+    """
+    Pull the list of vectors out of an embed_content response. The SDK's
+    layout is detected on the first call and reused; it is only re-detected
+    if a later response stops matching (e.g. after an SDK upgrade).
+    """
+    global _layout
+    if _layout is not None:
+        try:
+            return _layout[1](res)
+        except (KeyError, TypeError, ValueError, IndexError):
+            print(f"Embedding response no longer matches layout '{_layout[0]}', re-detecting")
+    for name, fn in _LAYOUTS:
+        try:
+            vectors = fn(res)
+        except (KeyError, TypeError, ValueError, IndexError):
+            continue
+        _layout = (name, fn)
+        return vectors
+    raise ValueError(f"Unexpected embedding response shape: {type(res)}")
 
 def _normalize_embedding(res) -> List[float]:
+    """Normalize a single-text response into a plain list[float]."""
+    return _extract(res)[0]
+
+def _cache_key(text: str) -> str:
+    return make_key(EMB_MODEL_ID, "semantic_similarity", text)
+
+def _embed_request(texts: List[str]) -> List[List[float]]:
+    res = genai.embed_content(model=EMB_MODEL_ID, content=texts, task_type="semantic_similarity")
+    vectors = _extract(res)
+    if len(vectors) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, got {len(vectors)}")
+    return vectors
+
+# Failures that say nothing about the inputs: retry them, but splitting the chunk won't help
+_TRANSIENT = (
+    google_exceptions.ServerError, google_exceptions.TooManyRequests, google_exceptions.RetryError,
+    OSError,  # connection errors and timeouts
+)
+
+def _embed_chunk(texts: List[str], retries: int = EMBED_RETRIES) -> List[List[float]]:
+    """
+    Embed one sub-batch, retrying just this chunk with backoff on transport,
+    429 and 5xx errors (and giving up when those persist). Any other failure
+    points at the inputs: each half is then embedded once, recursively, so a
+    single bad input can't sink the rest at a cost of at most 2n-1 requests
+    and no further sleeps.
+    """
+    last_error: Optional[Exception] = None
+    for attempt in range(retries + 1):
+        try:
+            with span("embed.batch", texts=len(texts), attempt=attempt):
+                return _embed_request(texts)
+        except Exception as e:
+            last_error = e
+            print(f"Embedding chunk of {len(texts)} failed (attempt {attempt + 1}): {e}")
+            if attempt < retries and isinstance(e, _TRANSIENT):
+                time.sleep(0.5 * 2 ** attempt)
+            else:
+                break
+    if len(texts) == 1 or isinstance(last_error, _TRANSIENT):
+        raise RuntimeError(f"Embedding failed after {attempt + 1} attempts: {last_error}") from last_error
+    mid = len(texts) // 2
+    return _embed_chunk(texts[:mid], retries=0) + _embed_chunk(texts[mid:], retries=0)
+
+class QuantizedVectorStore:
     """
-    Normalize possible SDK shapes into a plain list[float].
-    Handles:
-      - {'embedding': [floats...]}
-      - {'embedding': {'values': [floats...]}}
-      - {'data': [{'embedding': [floats...]}]}
-      - raw list [floats...]
+    Compact in-memory vector store: rows are L2-normalized, then kept as
+    float16 or int8 (symmetric per-row scale) in one contiguous NumPy buffer.
+
+    Per 768-dim vector that is ~1.5 KB (float16) or ~0.8 KB (int8) versus
+    ~30 KB for a Python list of floats. Cosine similarity is computed straight
+    from the quantized rows, dequantizing one block at a time into float32.
     """
-    if isinstance(res, dict):
-        if "embedding" in res:
-            emb = res["embedding"]
-            if isinstance(emb, dict) and "values" in emb:
-                return emb["values"]
-            if isinstance(emb, list):
-                return emb
-        if "data" in res and isinstance(res["data"], list) and res["data"]:
-            first = res["data"][0]
-            if isinstance(first, dict) and "embedding" in first:
-                e = first["embedding"]
-                if isinstance(e, dict) and "values" in e:
-                    return e["values"]
-                if isinstance(e, list):
-                    return e
-    if isinstance(res, list):
-        return res
-    raise ValueError("Unexpected embedding response shape")
+
+    BLOCK = 16384
+
+    def __init__(self, dtype: str = "int8", max_items: int = 1_000_000):
+        if dtype not in ("int8", "float16"):
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self.dtype = np.int8 if dtype == "int8" else np.float16
+        self.max_items = max_items
+        self._rows: Optional[np.ndarray] = None
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._index: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    @property
+    def nbytes(self) -> int:
+        rows = self._rows.itemsize * self._rows.shape[1] * len(self) if self._rows is not None else 0
+        return rows + 4 * len(self)
+
+    def _quantize(self, m: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        m = m / (np.linalg.norm(m, axis=1, keepdims=True) + 1e-9)
+        if self.dtype is np.float16:
+            return m.astype(np.float16), np.ones(len(m), dtype=np.float32)
+        scales = (np.abs(m).max(axis=1) / 127.0 + 1e-12).astype(np.float32)
+        q = np.clip(np.rint(m / scales[:, None]), -127, 127).astype(np.int8)
+        return q, scales
+
+    def _grow(self, need: int, dim: int) -> None:
+        cap = 0 if self._rows is None else len(self._rows)
+        if need <= cap:
+            return
+        new_cap = max(need, cap * 2, 1024)
+        rows = np.zeros((new_cap, dim), dtype=self.dtype)
+        scales = np.zeros(new_cap, dtype=np.float32)
+        if self._rows is not None:
+            rows[:len(self)] = self._rows[:len(self)]
+            scales[:len(self)] = self._scales[:len(self)]
+        self._rows, self._scales = rows, scales
+
+    def add_many(self, keys: List[str], vectors) -> None:
+        """Store vectors under keys; existing keys are skipped, and nothing is added once full."""
+        with self._lock:
+            fresh = [(k, v) for k, v in zip(keys, vectors) if k not in self._index]
+            fresh = fresh[: max(0, self.max_items - len(self))]
+            if not fresh:
+                return
+            m = np.asarray([v for _, v in fresh], dtype=np.float32)
+            if self._rows is not None and m.shape[1] != self._rows.shape[1]:
+                return
+            q, scales = self._quantize(m)
+            start = len(self)
+            self._grow(start + len(q), m.shape[1])
+            self._rows[start:start + len(q)] = q
+            self._scales[start:start + len(q)] = scales
+            for i, (k, _) in enumerate(fresh):
+                self._index[k] = start + i
+
+    def rows_for(self, keys: List[str]) -> np.ndarray:
+        return np.fromiter((self._index[k] for k in keys), dtype=np.int64, count=len(keys))
+
+    def get_many(self, keys: List[str]) -> np.ndarray:
+        """Dequantized float32 unit vectors for keys (all must be present)."""
+        rows = self.rows_for(keys)
+        return self._rows[rows].astype(np.float32) * self._scales[rows, None]
+
+    def cosine(self, query, keys: Optional[List[str]] = None) -> np.ndarray:
+        """Cosine of query against the stored rows for keys (or every row, in insertion order)."""
+        q = np.asarray(query, dtype=np.float32)
+        q = q / (np.linalg.norm(q) + 1e-9)
+        rows = self.rows_for(keys) if keys is not None else np.arange(len(self))
+        out = np.empty(len(rows), dtype=np.float32)
+        for i in range(0, len(rows), self.BLOCK):
+            block = rows[i:i + self.BLOCK]
+            out[i:i + len(block)] = (self._rows[block].astype(np.float32) @ q) * self._scales[block]
+        return out
+
+
+# Process-local tier in front of the shared SQLite cache
+_memory = QuantizedVectorStore(EMBED_MEMORY_DTYPE, EMBED_MEMORY_MAX) if EMBED_MEMORY_DTYPE != "none" else None
+
+def compare_with_exact(vectors: List[List[float]], query: List[float], k: int = 20) -> Dict[str, Dict[str, float]]:
+    """
+    Ranking-quality check for the quantized kernels against the exact
+    float64 cosine used by ranking_api: top-k overlap and worst score error.
+    """
+    m = np.asarray(vectors, dtype=np.float64)
+    q = np.asarray(query, dtype=np.float64)
+    exact = (m @ q) / ((np.linalg.norm(m, axis=1) + 1e-9) * (np.linalg.norm(q) + 1e-9))
+    exact_top = set(np.argsort(-exact)[:k].tolist())
+    report = {}
+    for dtype in ("float16", "int8"):
+        store = QuantizedVectorStore(dtype, max_items=len(vectors))
+        keys = [str(i) for i in range(len(vectors))]
+        store.add_many(keys, vectors)
+        approx = store.cosine(query, keys)
+        top = set(np.argsort(-approx)[:k].tolist())
+        report[dtype] = {
+            "top_k_overlap": len(top & exact_top) / max(1, min(k, len(vectors))),
+            "max_abs_error": float(np.max(np.abs(approx - exact))),
+            "bytes_per_vector": store.nbytes / max(1, len(store)),
+        }
+    return report
+
+def embed_matrix(texts: List[str]) -> np.ndarray:
+    """
+    Embeddings as a float32 (n, dim) array of unit rows, served from the
+    compact in-memory store when possible. Preferred over embed_texts for ranking.
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    keys = [_cache_key(t) for t in texts]
+    if _memory is None:
+        m = np.asarray(embed_texts(texts), dtype=np.float32)
+        return m / (np.linalg.norm(m, axis=1, keepdims=True) + 1e-9)
+    missing = [t for t, k in zip(texts, keys) if k not in _memory]
+    if missing:
+        embed_texts(missing)  # fills _memory
+    if all(k in _memory for k in keys):
+        return _memory.get_many(keys)
+    # store full: fall back to plain vectors
+    m = np.asarray(embed_texts(texts), dtype=np.float32)
+    return m / (np.linalg.norm(m, axis=1, keepdims=True) + 1e-9)
+
+def warm_up() -> None:
+    """Open the embedding channel with a one-text request that skips the caches and metering."""
+    _embed_request(["warm up"])
 
 def embed_text(text: str) -> List[float]:
-    res = genai.embed_content(model=EMB_MODEL_ID, content=text, task_type="semantic_similarity")
-    return _normalize_embedding(res)
+    return embed_texts([text])[0]
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
     """
-    Batch embed all texts in a single API call for massive performance gain.
-    Falls back to sequential if batch fails.
+    Embed texts, serving repeats from the in-memory store, then the shared
+    cache, and sending only the misses upstream. Vectors served from memory
+    are unit length and carry its quantization error (EMBED_MEMORY_DTYPE),
+    which only matters to callers that need raw magnitudes. Once the
+    tenant's embedding budget is spent only cache hits are served
+    (BudgetExceeded otherwise).
     """
     if not texts:
         return []
-    
-    if len(texts) == 1:
-        return [embed_text(texts[0])]
-    
-    try:
-        # Batch embed all texts at once
-        result = genai.embed_content(
-            model=EMB_MODEL_ID,
-            content=texts,
-            task_type="semantic_similarity"
-        )
-        
-        # Handle batch response format - Google API returns dict with 'embedding' key for batches
-        if isinstance(result, dict):
-            # Check for batch response with 'embedding' containing list of embeddings
-            if "embedding" in result:
-                emb = result["embedding"]
-                # If it's a list of vectors, return them
-                if isinstance(emb, list) and len(emb) > 0:
-                    if isinstance(emb[0], list):
-                        # Already a list of embeddings
-                        return emb
-                    elif isinstance(emb[0], (int, float)):
-                        # Single embedding vector
-                        return [emb]
-                # Otherwise normalize as single embedding
-                return [_normalize_embedding(result)]
-            # Check for 'embeddings' plural (some API versions)
-            elif "embeddings" in result:
-                embeddings = result["embeddings"]
-                if isinstance(embeddings, list):
-                    return [_normalize_embedding(e) for e in embeddings]
-        elif isinstance(result, list):
-            # List of embeddings
-            return [_normalize_embedding(r) for r in result]
-        
-        # Fallback to sequential
-        print(f"Unexpected batch embedding format: {type(result)}, falling back to sequential")
-        return [embed_text(t) for t in texts]
-    except Exception as e:
-        print(f"Batch embedding failed ({e}), falling back to sequential")
-        return [embed_text(t) for t in texts]
\ No newline at end of file
+    with span("embed", texts=len(texts)) as s:
+        return _embed_texts(texts, s)
+
+def _embed_texts(texts: List[str], s) -> List[List[float]]:
+    keys = [_cache_key(t) for t in texts]
+    unique = list(dict.fromkeys(keys))
+    # in-memory tier first (dequantized unit vectors); SQLite only for what it lacks
+    in_memory = [k for k in unique if k in _memory] if _memory is not None else []
+    found: Dict[str, List[float]] = dict(zip(in_memory, _memory.get_many(in_memory).tolist())) if in_memory else {}
+    found.update(_cache.get_many([k for k in unique if k not in found]))
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in found))
+    s.set(memory_hits=len(in_memory), misses=len(missing))
+    if missing:
+        meter.check("embed")
+        # one slot per call; its sub-batches share it
+        with embed_scheduler.slot():
+            started = time.perf_counter()
+            try:
+                vectors = _embed_batch(missing)
+            except Exception:
+                meter.record("embed", (time.perf_counter() - started) * 1000, units=len(missing), error=True)
+                raise
+            meter.record("embed", (time.perf_counter() - started) * 1000, units=len(missing))
+        fresh = {_cache_key(t): v for t, v in zip(missing, vectors)}
+        _cache.set_many(fresh)
+        found.update(fresh)
+    if _memory is not None:
+        _memory.add_many(list(found), list(found.values()))
+    return [found[k] for k in keys]
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Split texts into API-sized chunks and embed them concurrently
+    (at most EMBED_PARALLELISM in flight). Order is preserved.
+    """
+    chunks = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    if len(chunks) == 1:
+        return _embed_chunk(chunks[0])
+    # each chunk runs in a copy of the caller's context so its spans join the caller's trace
+    futures = [_pool.submit(contextvars.copy_context().run, _embed_chunk, c) for c in chunks]
+    out: List[List[float]] = []
+    for f in futures:
+        out.extend(f.result())
+    return out
+
+
+
+if __name__ == "__main__":
+    # Measure quantized ranking quality on real embeddings of sample tags
+    sample = [
+        "best dad shirt", "gift for father", "dad birthday gift", "family apparel",
+        "mens graphic tee", "fathers day top", "humor dad t-shirt", "retro soda jewelry",
+        "cartoon trip shirt", "mini basketball planter", "vintage dad hat", "funny papa tee",
+        "new dad gift", "daddy shark shirt", "grill master apron", "coffee lover mug",
+    ]
+    vectors = embed_texts(sample)
+    query = embed_text("PRODUCT TEXT: Best Dad NICE CLASS: 25")
+    for dtype, stats in compare_with_exact(vectors, query, k=5).items():
+        print(dtype, stats)
+    print("python list bytes/vector ~", 8 * len(query) + 24 * len(query) + 56)
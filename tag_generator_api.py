@@ -1,15 +1,23 @@
 import os
 import re
-from typing import Optional
+from typing import Callable, Optional
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form
 from pydantic import BaseModel, Field
 from PIL import Image  # For handling image objects
-import io
-from config import MODEL_ID, get_model
-from ranking_api import RankRequest, rank_phrases
-from tmcheck_api import check_one_phrase
+from typing import AsyncIterator
+from config import MODEL_ID, TAG_SUGGEST_MIN_SCORE, TAG_STREAMING, IMAGE_DEDUPE_ENABLED, get_model
+from ranking_api import RankRequest, rank_phrases, embed_anchor
+from tmcheck_api import check_one_phrase, check_outcome, check_until_safe, coarse_blocklist_hit, PhraseDecision
+from services_embed import embed_texts
+from tag_index import tag_index
+from uploads import ImageUpload, read_image_upload
+from image_dedupe import image_hashes, image_index
+from profiling import stage as profile_stage
+from usage_meter import meter, current_tenant, BudgetExceeded
+from updated_description_gen import compose_safe_listing_description_async
 import asyncio
+import threading
 
 model = get_model(MODEL_ID)
 
@@ -19,15 +27,238 @@ class TagGenerationResponse(BaseModel):
     """Defines the output structure, containing the list of generated tags."""
     tags: list[str]
 
+class TagsWithDescriptionResponse(BaseModel):
+    """Tags plus a safe listing description composed from them."""
+    tags: list[str]
+    safe_listing_description: str
+
+class TagSuggestionResponse(BaseModel):
+    """Suggested tags and how many came from the index vs. fresh generation."""
+    tags: list[str]
+    from_index: int
+    generated: int
+
 # --- Core Logic ---
-async def generate_tags_from_llm(nice_class: int, product_text: str, image: Optional[Image.Image] = None) -> list[str]:
+def _index_tags(tags: list[str], nice_class: int) -> None:
+    """Add verified-safe tags to the suggestion index (embeddings are usually cache hits)."""
+    try:
+        tag_index.add(tags, embed_texts(tags), nice_class)
+    except Exception as e:
+        print(f"DEBUG: Tag index update failed ({e})")
+
+def _generate_valid_tags(contents, generation_config: dict) -> list[str]:
+    response = model.generate_content(contents, generation_config=generation_config)
+
+    # --- Debug logging for tag generation pipeline ---
+    print("RAW RESPONSE TEXT:", repr(response.text))
+
+    if not response.text:
+        print("DEBUG: Model returned empty response.text")
+        return []
+
+    tags = [tag.strip() for tag in response.text.split('\n') if tag.strip()]
+    print("DEBUG: NUMBER OF TAGS FROM MODEL:", len(tags))
+
+    # same case-insensitive dedupe as the streaming path
+    seen: set[str] = set()
+    valid_tags = []
+    for tag in tags:
+        if len(tag) <= 20 and tag.lower() not in seen:
+            seen.add(tag.lower())
+            valid_tags.append(tag)
+    print("DEBUG: VALID TAGS (<=20 chars):", len(valid_tags))
+    return valid_tags
+
+async def _rank_tags(tags: list[str], rank_text: str, anchor_vector: Optional[list[float]], k: int = 20) -> list[str]:
+    if not tags:
+        return tags
+    try:
+        rank_req = RankRequest(
+            user_text=rank_text,
+            phrases=tags,
+            anchor_vector=anchor_vector,
+            k=k,
+        )
+        return await rank_phrases(rank_req)
+    except Exception as rank_error:
+        print(f"DEBUG: Ranking failed ({rank_error}), returning unranked tags")
+        # Return unranked tags if ranking fails
+        return tags[:k]
+
+async def _first_safe_tags(contents, generation_config: dict, nice_class: int, target: int, rank_text: str, anchor_vector, on_ranked=None) -> list[str]:
+    """
+    Early-exit pipeline: rank every candidate by embedding relevance first, then
+    check in rank order and stop at `target` verified-safe tags. The most
+    relevant safe tags come back without paying for checks on the tail.
+    """
+    valid_tags = await asyncio.to_thread(_generate_valid_tags, contents, generation_config)
+    ranked = await _rank_tags(valid_tags, rank_text, anchor_vector, k=max(1, min(len(valid_tags), 200)))
+    if not ranked:
+        return []
+
+    safe_tags, blocked, checked = await check_until_safe(ranked, nice_class, target)
+    print(f"DEBUG: EARLY EXIT: {len(safe_tags)} safe after {checked}/{len(ranked)} checks")
+    if not safe_tags:
+        print("DEBUG: No safe_tags after TM check, falling back to ranked tags")
+        return ranked[:20]
+
+    safe_tags = safe_tags[:target]
+    if on_ranked is not None:
+        on_ranked(safe_tags)
+    await asyncio.to_thread(_index_tags, safe_tags, nice_class)
+    return safe_tags
+
+async def _indexed_tags(nice_class: int, rank_text: str, anchor_vector: Optional[list[float]], budget: str, k: int = 20) -> list[str]:
+    """
+    Cheaper path once the tenant's LLM budget is spent: previously approved
+    tags for similar products, with no generation or TM checks.
+    """
+    if anchor_vector is None:
+        anchor_vector = await embed_anchor(rank_text)
+    hits = await asyncio.to_thread(tag_index.search, anchor_vector, nice_class, k, TAG_SUGGEST_MIN_SCORE)
+    if not hits:
+        raise BudgetExceeded(current_tenant(), budget)
+    print(f"DEBUG: {budget} budget exhausted, serving {len(hits)} indexed tags")
+    return [tag for tag, _ in hits]
+
+def _find_duplicate(image: Image.Image | ImageUpload, nice_class: int, product_text: str):
+    hashes = image_hashes(image)
+    return hashes, image_index.find(hashes, nice_class, product_text)
+
+async def _stream_lines(contents, generation_config: dict) -> AsyncIterator[str]:
+    """
+    Run model.generate_content(stream=True) in a worker thread and yield each
+    complete line of output as soon as its chunk arrives. If the consumer
+    stops early (error, cancellation) the worker stops reading at the next
+    chunk and closes the stream instead of draining it.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        response = None
+        try:
+            buf = ""
+            response = model.generate_content(contents, generation_config=generation_config, stream=True)
+            for chunk in response:
+                if stop.is_set():
+                    return
+                try:
+                    buf += chunk.text or ""
+                except ValueError:
+                    # chunk without text parts (e.g. the final finish_reason chunk)
+                    continue
+                *lines, buf = buf.split("\n")
+                for line in lines:
+                    loop.call_soon_threadsafe(queue.put_nowait, line)
+            if buf:
+                loop.call_soon_threadsafe(queue.put_nowait, buf)
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+        except Exception as e:
+            if not stop.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            if stop.is_set() and response is not None:
+                _close_stream(response)
+
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        await producer
+
+def _close_stream(response) -> None:
+    """Cancel the underlying gRPC/REST stream of an abandoned generate_content(stream=True) response."""
+    stream = getattr(response, "_iterator", None)
+    for name in ("cancel", "close"):
+        fn = getattr(stream, name, None)
+        if callable(fn):
+            try:
+                fn()
+            except Exception as e:
+                print(f"DEBUG: Closing tag stream failed ({e})")
+            return
+
+async def _generate_and_check_streaming(contents, generation_config: dict, nice_class: int):
+    """
+    Streaming counterpart of generate + gather: each tag is length-filtered and
+    blocklist-checked as soon as its line completes, and its USPTO check starts
+    while the model is still writing the rest of the list.
+    Returns (valid_tags, check_results) in the same shape as the batch path.
+    """
+    valid_tags: list[str] = []
+    checks: list[asyncio.Future] = []
+    seen = set()
+    total = 0
+    try:
+        async for line in _stream_lines(contents, generation_config):
+            tag = line.strip()
+            if not tag:
+                continue
+            total += 1
+            if len(tag) > 20 or tag.lower() in seen:
+                continue
+            seen.add(tag.lower())
+            valid_tags.append(tag)
+            hit = coarse_blocklist_hit(tag)
+            if hit:
+                blocked = asyncio.get_running_loop().create_future()
+                blocked.set_result(PhraseDecision(phrase=tag, reasons=[hit]))
+                checks.append(blocked)
+            else:
+                checks.append(asyncio.create_task(check_one_phrase(tag, nice_class)))
+    except BaseException:
+        for c in checks:
+            c.cancel()
+        raise
+
+    print("DEBUG: NUMBER OF TAGS FROM MODEL (streamed):", total)
+    print("DEBUG: VALID TAGS (<=20 chars):", len(valid_tags))
+    check_results = await asyncio.gather(*checks, return_exceptions=True)
+    return valid_tags, check_results
+
+
+async def generate_tags_from_llm(
+    nice_class: int,
+    product_text: str,
+    image: Optional[Image.Image | ImageUpload] = None,
+    anchor_vector: Optional[list[float]] = None,
+    stream: bool = TAG_STREAMING,
+    target_safe: Optional[int] = None,
+    on_ranked: Optional[Callable[[list[str]], None]] = None,
+) -> list[str]:
     """
     Generates 50 marketable tags using the generative AI model based on an image.
 
     Args:
         nice_class: The product's Nice Classification code.
         product_text: Text found on the product.
-        image: A PIL Image object of the product.
+        image: The product image, as an ImageUpload (raw bytes go to the model as-is)
+            or a PIL Image object.
+        anchor_vector: Optional precomputed ranking anchor (see ranking_api.embed_anchor);
+            when omitted, tags are ranked against the product text and Nice class.
+        stream: Stream the model output and start each tag's TM check as soon as
+            its line is complete, overlapping generation with USPTO lookups.
+        target_safe: "First N safe" mode: rank all candidates first, check them in
+            rank order and stop once this many are verified safe (see check_until_safe).
+
+        on_ranked: Called with the final ranked tags as soon as they exist, before
+            the suggestion index is updated, so follow-up work can start early.
+
+    Once the caller's LLM budget is spent, tags come from the suggestion index instead.
+
+    Images that are near-duplicates (perceptual hash, see image_dedupe) of one
+    already processed for the same Nice class and product text reuse its
+    checked tags, re-ranked for this anchor, without calling the model.
 
     Returns:
         A list of generated tags filtered for trademark safety and ranked by relevance.
@@ -65,43 +296,52 @@ async def generate_tags_from_llm(nice_class: int, product_text: str, image: Opti
     try:
         parts = [prompt]
         if image is not None:
-            parts.append(image)
-        response = model.generate_content(
-            parts if len(parts) > 1 else prompt,
-            generation_config={"temperature": 0.7}
-        )
+            parts.append(image.part if isinstance(image, ImageUpload) else image)
+        contents = parts if len(parts) > 1 else prompt
+        generation_config = {"temperature": 0.7}
+        rank_text = f"PRODUCT TEXT: {product_text} NICE CLASS: {nice_class}"
+
+        hashes = None
+        hashable = image is not None and (not isinstance(image, ImageUpload) or image.decodable)
+        if hashable and IMAGE_DEDUPE_ENABLED:
+            with profile_stage("dedupe"):
+                hashes, reused = await asyncio.to_thread(_find_duplicate, image, nice_class, product_text)
+            if reused and len(reused) >= (target_safe or 1):
+                with profile_stage("rank"):
+                    tags = await _rank_tags(reused, rank_text, anchor_vector)
+                tags = tags[:target_safe] if target_safe else tags
+                if on_ranked is not None:
+                    on_ranked(tags)
+                return tags
 
-        # --- Debug logging for tag generation pipeline ---
-        print("RAW RESPONSE TEXT:", repr(response.text))
+        budget = await meter.over_budget_async("llm")
+        if budget is not None:
+            return await _indexed_tags(nice_class, rank_text, anchor_vector, budget)
 
-        if not response.text:
-            print("DEBUG: Model returned empty response.text")
-            return []
+        if target_safe:
+            with profile_stage("first_safe"):
+                return await _first_safe_tags(contents, generation_config, nice_class, target_safe, rank_text, anchor_vector, on_ranked)
 
-        tags = [tag.strip() for tag in response.text.split('\n') if tag.strip()]
-        print("DEBUG: NUMBER OF TAGS FROM MODEL:", len(tags))
+        if stream:
+            with profile_stage("generate+tm_check"):
+                valid_tags, check_results = await _generate_and_check_streaming(contents, generation_config, nice_class)
+        else:
+            with profile_stage("generate"):
+                valid_tags = await asyncio.to_thread(_generate_valid_tags, contents, generation_config)
 
-        valid_tags = [tag for tag in tags if len(tag) <= 20]
-        print("DEBUG: VALID TAGS (<=20 chars):", len(valid_tags))
+            # Check trademark safety via USPTO for each tag
+            with profile_stage("tm_check"):
+                check_tasks = [check_one_phrase(tag, nice_class) for tag in valid_tags]
+                check_results = await asyncio.gather(*check_tasks, return_exceptions=True)
 
-        # Check trademark safety via USPTO for each tag
+        # Keep the tags that passed the trademark check
+        verified = False
         if valid_tags:
-            check_tasks = [check_one_phrase(tag, nice_class) for tag in valid_tags]
-            check_results = await asyncio.gather(*check_tasks, return_exceptions=True)
-            
-            # Filter out blocked tags (those that returned a PhraseDecision) and exceptions
-            safe_tags = []
-            for i, result in enumerate(check_results):
-                if isinstance(result, Exception):
-                    print(f"DEBUG: TM check exception for '{valid_tags[i]}': {result}")
-                    # On error, assume safe (fail open)
-                    safe_tags.append(valid_tags[i])
-                elif result is None:
-                    # None means safe
-                    safe_tags.append(valid_tags[i])
-                # else: result is PhraseDecision, blocked
+            # Filter out blocked tags (those that returned a PhraseDecision); on error, assume safe (fail open)
+            safe_tags = [tag for tag, result in zip(valid_tags, check_results) if check_outcome(tag, result) is None]
             
             print("DEBUG: SAFE TAGS AFTER TM CHECK:", len(safe_tags))
+            verified = bool(safe_tags)
 
             # If all tags were filtered out by the TM check, fall back to the original valid tags
             if not safe_tags:
@@ -111,49 +351,54 @@ async def generate_tags_from_llm(nice_class: int, product_text: str, image: Opti
             safe_tags = []
 
         # Apply semantic ranking to reorder safe tags by relevance
-        if safe_tags:
-            try:
-                rank_req = RankRequest(
-                    user_text=f"PRODUCT TEXT: {product_text} NICE CLASS: {nice_class}",
-                    phrases=safe_tags
-                )
-                safe_tags = await rank_phrases(rank_req)
-            except Exception as rank_error:
-                print(f"DEBUG: Ranking failed ({rank_error}), returning unranked tags")
-                # Return unranked tags if ranking fails
-                pass
+        with profile_stage("rank"):
+            safe_tags = await _rank_tags(safe_tags, rank_text, anchor_vector)
+        if on_ranked is not None:
+            on_ranked(safe_tags)
+
+        # Only tags that actually passed the TM check are reusable by /tags/suggest
+        if verified and safe_tags:
+            with profile_stage("index"):
+                await asyncio.to_thread(_index_tags, safe_tags, nice_class)
+                if hashes is not None:
+                    await asyncio.to_thread(image_index.add, hashes, nice_class, product_text, safe_tags)
 
         return safe_tags
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"An error occurred during LLM call: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate tags due to an internal error: {e}")
 
 
 # --- API Endpoint ---
+async def _load_image(image_file: Optional[UploadFile]) -> Optional[ImageUpload]:
+    if image_file is None:
+        return None
+    if not image_file.content_type or not image_file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+    with profile_stage("upload"):
+        return await read_image_upload(image_file)
+
 @router.post("/generate", response_model=TagGenerationResponse)
 async def generate_marketable_tags(
     nice_class: int = Form(...),
     product_text: str = Form(default=""),
+    target_safe: Optional[int] = Form(default=None, ge=1, le=50),
     image_file: Optional[UploadFile] = File(None)
 ):
     """
     API endpoint to generate 50 marketable tags based on a product image and info.
+    With target_safe, stops trademark checks once that many tags are verified safe.
     """
-    image_pil = None
-    if image_file is not None:
-        if not image_file.content_type or not image_file.content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
-        try:
-            image_bytes = await image_file.read()
-            image_pil = Image.open(io.BytesIO(image_bytes))
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to read or process image file: {e}")
+    image_upload = await _load_image(image_file)
 
     tags = await generate_tags_from_llm(
         nice_class=nice_class,
         product_text=product_text,
-        image=image_pil
+        image=image_upload,
+        target_safe=target_safe,
     )
     
     if not tags:
@@ -161,6 +406,101 @@ async def generate_marketable_tags(
         
     return TagGenerationResponse(tags=tags)
 
+@router.post("/generate-with-description", response_model=TagsWithDescriptionResponse)
+async def generate_tags_with_description(
+    nice_class: int = Form(...),
+    product_text: str = Form(default=""),
+    title: str = Form(default=""),
+    target_safe: Optional[int] = Form(default=None, ge=1, le=50),
+    image_file: Optional[UploadFile] = File(None)
+):
+    """
+    /tags/generate and /compose/safe-description in one round trip. The
+    description is composed from the ranked tags as soon as they exist,
+    overlapping the suggestion-index update. title defaults to the first
+    160 characters of product_text. A failed description comes back empty.
+    """
+    image_upload = await _load_image(image_file)
+    title = (title or product_text[:160]).strip()
+    description_task: Optional[asyncio.Task] = None
+
+    def start_description(tags: list[str]) -> None:
+        nonlocal description_task
+        if tags and description_task is None:
+            description_task = asyncio.create_task(
+                compose_safe_listing_description_async(title=title, safe_phrases=tags)
+            )
+
+    try:
+        tags = await generate_tags_from_llm(
+            nice_class=nice_class,
+            product_text=product_text,
+            image=image_upload,
+            target_safe=target_safe,
+            on_ranked=start_description,
+        )
+    except BaseException:
+        if description_task is not None:
+            description_task.cancel()
+        raise
+
+    if not tags:
+        raise HTTPException(status_code=500, detail="Tag generation failed, model returned no content.")
+
+    start_description(tags)  # paths that return before ranking (index fallback)
+    try:
+        description = (await description_task or "").strip()
+    except Exception as e:
+        print(f"DEBUG: Description generation failed ({e})")
+        description = ""
+
+    return TagsWithDescriptionResponse(tags=tags, safe_listing_description=description)
+
+@router.post("/suggest", response_model=TagSuggestionResponse)
+async def suggest_tags(
+    nice_class: int = Form(...),
+    product_text: str = Form(default=""),
+    k: int = Form(default=20, ge=1, le=50),
+    min_score: float = Form(default=TAG_SUGGEST_MIN_SCORE),
+    image_file: Optional[UploadFile] = File(None)
+):
+    """
+    Suggest tags from the index of previously approved tags for similar products.
+    Falls back to LLM generation only when the index has fewer than k good matches.
+    """
+    anchor_text = f"PRODUCT TEXT: {product_text} NICE CLASS: {nice_class}"
+    try:
+        anchor_vector = await embed_anchor(anchor_text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Embedding failed: {e}")
+
+    hits = await asyncio.to_thread(tag_index.search, anchor_vector, nice_class, k, min_score)
+    tags = [tag for tag, _ in hits]
+    from_index = len(tags)
+
+    if len(tags) < k:
+        image_upload = await _load_image(image_file)
+        fresh = await generate_tags_from_llm(
+            nice_class=nice_class,
+            product_text=product_text,
+            image=image_upload,
+            anchor_vector=anchor_vector,
+        )
+        seen = {t.lower() for t in tags}
+        for tag in fresh:
+            if tag.lower() not in seen:
+                seen.add(tag.lower())
+                tags.append(tag)
+                if len(tags) == k:
+                    break
+
+    if not tags:
+        raise HTTPException(status_code=500, detail="Tag suggestion failed, no tags available.")
+
+    return TagSuggestionResponse(tags=tags, from_index=from_index, generated=len(tags) - from_index)
+
 # --- Direct Execution for Testing ---
 if __name__ == "__main__":
     """
@@ -0,0 +1,243 @@
+# tag_index.py
+import time
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+import numpy as np
+
+from cache_store import get_db
+from config import CACHE_ENABLED
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tag_index (
+    id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL,
+    tag_key TEXT NOT NULL,
+    nice_class INTEGER NOT NULL,
+    vec BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (tag_key, nice_class)
+)
+"""
+
+# Below this size an exact scan is already a few ms; above it we build IVF lists.
+IVF_MIN_SIZE = 20000
+IVF_TRAIN_SAMPLE = 10000
+IVF_ITERS = 8
+IVF_NPROBE = 8
+REFRESH_EVERY = 2.0  # seconds between checks for rows added by other workers
+
+
+def _unit(m: np.ndarray) -> np.ndarray:
+    return m / (np.linalg.norm(m, axis=-1, keepdims=True) + 1e-9)
+
+
+class TagIndex:
+    """
+    Approximate nearest-neighbour index of previously approved tags.
+
+    Rows (tag, Nice class, float32 unit vector) persist in the shared SQLite
+    file so every worker sees what the others approved. Each process keeps an
+    in-memory copy; once it passes IVF_MIN_SIZE rows it is partitioned with
+    spherical k-means (IVF) and searches only probe the closest lists. The
+    IVF build runs on a background thread; searches keep using the previous
+    lists (or an exact scan) until it is swapped in.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tags: List[str] = []
+        # preallocated, grown by doubling; rows [0, len) are never rewritten
+        self._class_buf = np.zeros(0, dtype=np.int32)
+        self._vec_buf = np.zeros((0, 0), dtype=np.float32)
+        self._last_id = 0
+        self._last_refresh = 0.0
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []
+        self._built_size = 0
+        self._building = False
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    @property
+    def _vecs(self) -> np.ndarray:
+        return self._vec_buf[:len(self._tags)]
+
+    @property
+    def _classes(self) -> np.ndarray:
+        return self._class_buf[:len(self._tags)]
+
+    def _grow(self, need: int, dim: int) -> None:
+        cap = len(self._vec_buf)
+        if need <= cap:
+            return
+        new_cap = max(need, cap * 2, 1024)
+        vecs = np.zeros((new_cap, dim), dtype=np.float32)
+        classes = np.zeros(new_cap, dtype=np.int32)
+        n = len(self._tags)
+        if n:
+            vecs[:n] = self._vec_buf[:n]
+            classes[:n] = self._class_buf[:n]
+        self._vec_buf, self._class_buf = vecs, classes
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_db()
+        conn.execute(_SCHEMA)
+        return conn
+
+    # --- loading ---
+
+    def _refresh(self, force: bool = False) -> None:
+        if not CACHE_ENABLED:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_refresh < REFRESH_EVERY:
+            return
+        self._last_refresh = now
+        try:
+            rows = self._db().execute(
+                "SELECT id, tag, nice_class, vec FROM tag_index WHERE id > ? ORDER BY id", (self._last_id,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"tag_index refresh failed: {e}")
+            return
+        if not rows:
+            return
+        self._last_id = rows[-1][0]
+        dim = self._vec_buf.shape[1] if self._tags else None
+        kept, vecs = [], []
+        for r in rows:
+            v = np.frombuffer(r[3], dtype=np.float32)
+            dim = dim or v.shape[0]
+            if v.shape[0] == dim:
+                kept.append(r)
+                vecs.append(v)
+        if len(kept) < len(rows):
+            print(f"tag_index: skipped {len(rows) - len(kept)} rows with a different embedding dim")
+        if not kept:
+            return
+        start = len(self._tags)
+        self._grow(start + len(kept), dim)
+        self._vec_buf[start:start + len(kept)] = np.stack(vecs)
+        self._class_buf[start:start + len(kept)] = [r[2] for r in kept]
+        self._tags.extend(r[1] for r in kept)
+
+        n = len(self._tags)
+        if self._centroids is not None:
+            self._assign(range(start, n))
+        if n >= IVF_MIN_SIZE and n >= 2 * self._built_size and not self._building:
+            self._building = True
+            # rows below n are never rewritten (growing copies to a new buffer), so the thread can read this view unlocked
+            threading.Thread(target=self._build_ivf, args=(self._vecs,), name="tag-index-ivf", daemon=True).start()
+
+    def _build_ivf(self, vecs: np.ndarray) -> None:
+        try:
+            centroids, lists = self._train_ivf(vecs)
+        except Exception as e:
+            print(f"tag_index IVF build failed: {e}")
+            with self._lock:
+                self._building = False
+            return
+        n = len(vecs)
+        with self._lock:
+            self._centroids, self._lists, self._built_size = centroids, lists, n
+            self._building = False
+            if len(self._tags) > n:
+                # rows loaded while the build ran
+                self._assign(range(n, len(self._tags)))
+        print(f"tag_index: IVF built over {n} rows ({len(lists)} lists)")
+
+    @staticmethod
+    def _train_ivf(vecs: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+        n = len(vecs)
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(0)
+        sample = vecs[rng.choice(n, size=min(n, IVF_TRAIN_SAMPLE), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(IVF_ITERS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)[:, None]
+            # keep the old centroid for empty clusters
+            centroids = np.where(counts > 0, _unit(sums), centroids)
+        centroids = centroids.astype(np.float32)
+        labels = np.argmax(vecs @ centroids.T, axis=1)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(nlist + 1))
+        return centroids, [order[bounds[c]:bounds[c + 1]].astype(np.int64) for c in range(nlist)]
+
+    def _assign(self, rows) -> None:
+        rows = np.fromiter(rows, dtype=np.int64)
+        labels = np.argmax(self._vecs[rows] @ self._centroids.T, axis=1)
+        for c in np.unique(labels):
+            self._lists[c] = np.concatenate([self._lists[c], rows[labels == c]])
+
+    # --- public API ---
+
+    def refresh(self) -> None:
+        """Load rows approved since the last refresh (by any worker), starting an IVF rebuild if due."""
+        with self._lock:
+            self._refresh(force=True)
+
+    def add(self, tags: List[str], vectors: List[List[float]], nice_class: int) -> None:
+        """Record approved tags; duplicates (case-insensitive, per class) are ignored."""
+        if not CACHE_ENABLED or not tags:
+            return
+        vecs = _unit(np.asarray(vectors, dtype=np.float32))
+        now = time.time()
+        rows = [(t, t.strip().lower(), int(nice_class), v.tobytes(), now) for t, v in zip(tags, vecs)]
+        try:
+            conn = self._db()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO tag_index (tag, tag_key, nice_class, vec, created_at) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            print(f"tag_index add failed: {e}")
+            return
+        self.refresh()  # so this worker finds them right away
+
+    def search(self, vector: List[float], nice_class: Optional[int], k: int, min_score: float = 0.0) -> List[Tuple[str, float]]:
+        """
+        Top-k (tag, cosine) pairs for a query vector, optionally restricted to
+        one Nice class. May read SQLite and scan every row, so call it off the
+        event loop.
+        """
+        with self._lock:
+            self._refresh()
+            if not self._tags:
+                return []
+            q = _unit(np.asarray(vector, dtype=np.float32))
+            if q.shape[0] != self._vecs.shape[1]:
+                return []
+            if self._centroids is not None:
+                probe = np.argsort(-(self._centroids @ q))[:IVF_NPROBE]
+                cand = np.concatenate([self._lists[c] for c in probe])
+            else:
+                cand = np.arange(len(self._tags))
+            if nice_class is not None:
+                cand = cand[self._classes[cand] == nice_class]
+            if not cand.size:
+                return []
+            scores = self._vecs[cand] @ q
+            top = np.argsort(-scores)[: k * 2]  # headroom for same-tag rows across classes
+            out, seen = [], set()
+            for i in top:
+                score = float(scores[i])
+                if score < min_score:
+                    break
+                tag = self._tags[cand[i]]
+                if tag.lower() in seen:
+                    continue
+                seen.add(tag.lower())
+                out.append((tag, score))
+                if len(out) == k:
+                    break
+            return out
+
+
+tag_index = TagIndex()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# flat-module app: make the repo root importable, satisfy the required keys
+# (no test calls an upstream API) and keep tests off the shared cache file
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("RAPIDAPI_KEY", "test")
+os.environ.setdefault("CACHE_ENABLED", "0")
@@ -0,0 +1,37 @@
+import asyncio
+
+import tmcheck_api
+from tmcheck_api import PhraseDecision, check_until_safe
+
+
+def _fake_checks(monkeypatch, blocked=(), failing=()):
+    async def check_one_phrase(phrase, nice_class):
+        await asyncio.sleep(0)
+        if phrase in failing:
+            raise RuntimeError("USPTO unavailable")
+        if phrase in blocked:
+            return PhraseDecision.model_construct(phrase=phrase, reasons=["blocked"])
+        return None
+
+    monkeypatch.setattr(tmcheck_api, "check_one_phrase", check_one_phrase)
+
+
+def test_check_until_safe_returns_target_in_rank_order(monkeypatch):
+    _fake_checks(monkeypatch, blocked={"b", "d"})
+    safe, blocked, _ = asyncio.run(check_until_safe(["a", "b", "c", "d", "e", "f", "g"], 25, 3))
+    assert safe == ["a", "c", "e"]
+    assert list(blocked) == ["b", "d"]
+
+
+def test_check_until_safe_fails_open_like_the_gather_path(monkeypatch):
+    _fake_checks(monkeypatch, blocked={"c"}, failing={"a"})
+    phrases = ["a", "b", "c", "d"]
+    safe, blocked, _ = asyncio.run(check_until_safe(phrases, 25, 3))
+
+    async def gathered():
+        results = await asyncio.gather(*(tmcheck_api.check_one_phrase(p, 25) for p in phrases), return_exceptions=True)
+        return [p for p, r in zip(phrases, results) if tmcheck_api.check_outcome(p, r) is None]
+
+    assert safe == ["a", "b", "d"]
+    assert "a" not in blocked
+    assert safe == asyncio.run(gathered())
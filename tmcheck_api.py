@@ -1,10 +1,14 @@
 # tmcheck_api.py
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, validator
 import asyncio
+import re
 
 from uspto_client import check_trademark_available, TMError
+from config import TM_EARLY_EXIT_CONCURRENCY
+from tracing import span
 
 router = APIRouter(prefix="/tmcheck", tags=["tmcheck"])
 
@@ -15,6 +19,7 @@ class TMCheckRequest(BaseModel):
     nice_class: Optional[int] = Field(None, description="Nice class code, e.g., 25")
     min_safe: int = Field(8, ge=1, le=50, description="Minimum safe phrases to return")
     fallback_defaults: List[str] = Field(default_factory=list, description="Fallback safe-ish generics")
+    stop_at_min_safe: bool = Field(False, description="Treat phrases as priority-ordered and stop checking once min_safe are verified safe")
 
     @validator("phrases")
     def _limit_phrases(cls, v):
@@ -33,6 +38,7 @@ class TMCheckRequest(BaseModel):
         return out
 
 class PhraseDecision(BaseModel):
+    # built internally with model_construct (no validation); fields are always well-formed
     phrase: str
     reasons: List[str]
 
@@ -57,11 +63,20 @@ FAMOUS_MARKS = {
     "tesla","google","instagram","tiktok","youtube",
 }
 
+_mark_matcher: Optional[re.Pattern] = None
+
+def mark_matcher() -> re.Pattern:
+    """One regex alternation over FAMOUS_MARKS (longest first), built on first use or at warm-up."""
+    global _mark_matcher
+    if _mark_matcher is None:
+        marks = sorted(FAMOUS_MARKS, key=len, reverse=True)
+        _mark_matcher = re.compile("|".join(re.escape(m) for m in marks))
+    return _mark_matcher
+
 def coarse_blocklist_hit(phrase: str) -> Optional[str]:
-    s = phrase.lower()
-    for mark in FAMOUS_MARKS:
-        if mark in s:
-            return f"famous mark detected: {mark}"
+    match = mark_matcher().search(phrase.lower())
+    if match:
+        return f"famous mark detected: {match.group(0)}"
     return None
 
 def interpret_trademark_available_response(resp: Dict[str, Any]) -> Optional[str]:
@@ -120,19 +135,25 @@ async def check_one_phrase(phrase: str, nice_class: Optional[int]) -> PhraseDeci
     """
     Returns PhraseDecision if BLOCKED, or None if SAFE.
     """
+    with span("tm.check_phrase", phrase=phrase) as s:
+        decision = await _check_one_phrase(phrase, nice_class)
+        s.set(blocked=decision is not None)
+        return decision
+
+async def _check_one_phrase(phrase: str, nice_class: Optional[int]) -> PhraseDecision | None:
     reasons: List[str] = []
 
     # 1) quick local blocklist
     hit = coarse_blocklist_hit(phrase)
     if hit:
-        return PhraseDecision(phrase=phrase, reasons=[hit])
+        return PhraseDecision.model_construct(phrase=phrase, reasons=[hit])
 
     # 2) remote availability
         # 2) remote availability
     try:
         resp = await check_trademark_available(phrase)
     except Exception as e:
-        return PhraseDecision(phrase=phrase, reasons=[f"USPTO call exception: {e}"])
+        return PhraseDecision.model_construct(phrase=phrase, reasons=[f"USPTO call exception: {e}"])
 
     reason = interpret_trademark_available_response(resp)
     if reason:
@@ -147,7 +168,81 @@ async def check_one_phrase(phrase: str, nice_class: Optional[int]) -> PhraseDeci
     # if nice_class is not None and class_hits_include(nice_class, resp):
     #     reasons.append(f"class {nice_class} conflict")
 
-    return PhraseDecision(phrase=phrase, reasons=reasons) if reasons else None
+    return PhraseDecision.model_construct(phrase=phrase, reasons=reasons) if reasons else None
+
+def check_outcome(phrase: str, result) -> Optional[PhraseDecision]:
+    """
+    Verdict for one check_one_phrase result, which may be an exception (as
+    from gather(return_exceptions=True)). A check that raised counts as safe
+    (fail open): every tag path applies this same policy.
+    """
+    if isinstance(result, Exception):
+        print(f"DEBUG: TM check exception for '{phrase}': {result}")
+        return None
+    return result
+
+async def check_until_safe(
+    phrases: List[str],
+    nice_class: Optional[int],
+    target: int,
+    concurrency: int = TM_EARLY_EXIT_CONCURRENCY,
+) -> Tuple[List[str], Dict[str, PhraseDecision], int]:
+    """
+    Check phrases in the given (priority) order and stop once the first
+    `target` safe phrases in that order are settled: `target` are verified
+    safe and every phrase ranked above the last of them has been checked.
+    Checks ranked below the cutoff are cancelled. In-flight checks are capped
+    at what could still be needed (plus a little headroom for blocked ones),
+    so most USPTO calls past the target are never made.
+
+    A check that raises counts as safe, see check_outcome.
+
+    Returns (safe phrases in priority order, blocked map, number of completed checks).
+    """
+    if target <= 0:
+        return [], {}, 0
+    safe_idx: List[int] = []
+    blocked_idx: Dict[int, PhraseDecision] = {}
+    pending: Dict[asyncio.Task, int] = {}
+    next_i = 0
+    checked = 0
+    headroom = 2
+
+    try:
+        while True:
+            cutoff = sorted(safe_idx)[target - 1] if len(safe_idx) >= target else None
+            if cutoff is None:
+                limit = min(concurrency, target - len(safe_idx) + headroom)
+                while next_i < len(phrases) and len(pending) < limit:
+                    pending[asyncio.create_task(check_one_phrase(phrases[next_i], nice_class))] = next_i
+                    next_i += 1
+            else:
+                # only checks ranked above the cutoff can still change the result
+                for task, i in list(pending.items()):
+                    if i > cutoff:
+                        task.cancel()
+                        del pending[task]
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = pending.pop(task)
+                checked += 1
+                result = check_outcome(phrases[i], task.exception() or task.result())
+                if result is None:
+                    safe_idx.append(i)
+                else:
+                    blocked_idx[i] = result
+    finally:
+        for task in pending:
+            task.cancel()
+
+    safe_idx = sorted(safe_idx)[:target]
+    if len(safe_idx) == target:
+        # blocked phrases past the cutoff depend on completion order, leave them out
+        blocked_idx = {i: d for i, d in blocked_idx.items() if i < safe_idx[-1]}
+    blocked = {d.phrase: d for _, d in sorted(blocked_idx.items())}
+    return [phrases[i] for i in safe_idx], blocked, checked
 
 # --- Route ---
 
@@ -155,12 +250,17 @@ async def check_one_phrase(phrase: str, nice_class: Optional[int]) -> PhraseDeci
 async def verify_phrases(req: TMCheckRequest):
     phrases = req.phrases
 
-    # Parallelize the remote checks
-    tasks = [check_one_phrase(p, req.nice_class) for p in phrases]
-    results = await asyncio.gather(*tasks)
+    if req.stop_at_min_safe:
+        # Early exit: phrases are in priority order, stop at min_safe verified
+        safe, blocked_map, checked = await check_until_safe(phrases, req.nice_class, req.min_safe)
+    else:
+        # Parallelize the remote checks
+        tasks = [check_one_phrase(p, req.nice_class) for p in phrases]
+        results = await asyncio.gather(*tasks)
 
-    blocked_map = {r.phrase: r for r in results if r is not None}
-    safe = [p for p in phrases if p not in blocked_map]
+        blocked_map = {r.phrase: r for r in results if r is not None}
+        safe = [p for p in phrases if p not in blocked_map]
+        checked = len(phrases)
 
     # Ensure minimum safe by topping up from fallbacks
     if len(safe) < req.min_safe and req.fallback_defaults:
@@ -178,17 +278,17 @@ async def verify_phrases(req: TMCheckRequest):
             if len(safe) >= req.min_safe:
                 break
 
-    blocked = list(blocked_map.values())
-
-    return TMCheckResponse(
-        ok=True,
-        safe=safe,
-        blocked=blocked,
-        meta={
-            "checked": len(phrases),
+    # Built from already-checked values, so skip response_model validation
+    return ORJSONResponse({
+        "ok": True,
+        "safe": safe,
+        "blocked": [{"phrase": d.phrase, "reasons": d.reasons} for d in blocked_map.values()],
+        "meta": {
+            "checked": checked,
+            "unchecked": len(phrases) - checked,
             "safe_count": len(safe),
             "min_safe_required": req.min_safe,
             "nice_class": req.nice_class,
             "api": "uspto-trademark.p.rapidapi.com",
         },
-    )
+    })
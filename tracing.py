@@ -0,0 +1,427 @@
+# tracing.py
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import secrets
+import threading
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import httpx
+from fastapi import APIRouter, HTTPException, Request
+
+from config import (
+    TRACE_HEADER, TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_FILE_MAX_BYTES,
+    TRACE_OTLP_ENDPOINT, TRACE_SLOW_MS, TRACE_KEEP,
+)
+
+router = APIRouter(prefix="/debug/traces", tags=["debug"])
+
+SERVICE_NAME = "p-tagsafe"
+EXPORT_QUEUE_MAX = 1000
+EXPORT_BATCH = 100
+
+# The trace of the request being handled (None when it isn't traced) and the innermost open span
+_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_parent: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_parent", default=None)
+
+
+class Span:
+    """One timed operation. Attributes can be added until it ends."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "start_ns", "end_ns", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def end(self, error: Optional[str] = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        self.error = error
+        self.trace.add(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _NoSpan:
+    """Stand-in yielded when the request isn't traced, so call sites needn't check."""
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def end(self, error: Optional[str] = None) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    Finished spans of one request. Spans are added from the event loop and
+    from worker threads (asyncio.to_thread copies the context). Spans that
+    end after the request has been exported (background tasks, compose jobs)
+    are exported on their own under the same trace id.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None, remote_parent: Optional[str] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.remote_parent = remote_parent
+        self.root: Optional[Span] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.exported = False
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            if not self.exported:
+                self.spans.append(span.to_dict())
+                return
+        exporter.submit({"trace_id": self.trace_id, "spans": [span.to_dict()]})
+
+    def finish(self) -> Dict[str, Any]:
+        with self._lock:
+            self.exported = True
+            spans = list(self.spans)
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name if root else None,
+            "start_ns": root.start_ns if root else None,
+            "duration_ms": round((root.end_ns - root.start_ns) / 1e6, 2) if root and root.end_ns else None,
+            "status_code": root.attrs.get("status_code") if root else None,
+            "spans": spans,
+            "critical_path": critical_path(spans, root.span_id if root else None),
+        }
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+def start_span(name: str, **attrs: Any):
+    """
+    Open a span that the caller ends explicitly (span.end()), e.g. when the
+    work outlives the calling frame. It does not become the parent of spans
+    opened meanwhile; use `span` for that.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, _parent.get(), attrs)
+
+
+@contextmanager
+def span(name: str, **attrs: Any):
+    """Time the block as a child of the current span; a no-op unless the request is traced."""
+    trace = _trace.get()
+    if trace is None:
+        yield NO_SPAN
+        return
+    s = Span(trace, name, _parent.get(), attrs)
+    token = _parent.set(s.span_id)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _parent.reset(token)
+        s.end(error)
+
+
+# --- critical path ---
+
+def critical_path(spans: List[Dict[str, Any]], root_id: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    The chain of spans that determined the request's duration. Starting from
+    the root, walk back from a span's end: the child that finished last is on
+    the path, then the last child that finished before that one started, and
+    so on; recurse into each. Children running concurrently with a path child
+    (e.g. the other 49 USPTO checks of a gather) are left out. `self_ms` is
+    the time on the path not covered by a child.
+    """
+    by_id = {s["span_id"]: s for s in spans}
+    if root_id not in by_id:
+        return []
+    children = defaultdict(list)
+    for s in spans:
+        children[s["parent_id"]].append(s)
+    t0 = by_id[root_id]["start_ns"]
+    out: List[Dict[str, Any]] = []
+
+    def walk(node: Dict[str, Any], end_ns: int, depth: int) -> None:
+        entry = {
+            "name": node["name"],
+            "span_id": node["span_id"],
+            "depth": depth,
+            "start_ms": round((node["start_ns"] - t0) / 1e6, 2),
+            "duration_ms": round((end_ns - node["start_ns"]) / 1e6, 2),
+            "self_ms": 0.0,
+            "attrs": node["attrs"],
+        }
+        out.append(entry)
+        cursor, picked = end_ns, []
+        for child in sorted(children[node["span_id"]], key=lambda c: min(c["end_ns"], end_ns), reverse=True):
+            if child["start_ns"] < cursor:
+                child_end = min(child["end_ns"], cursor)
+                picked.append((child, child_end))
+                cursor = child["start_ns"]
+        covered = sum(child_end - max(child["start_ns"], node["start_ns"]) for child, child_end in picked)
+        entry["self_ms"] = round((end_ns - node["start_ns"] - covered) / 1e6, 2)
+        for child, child_end in reversed(picked):
+            walk(child, child_end, depth + 1)
+
+    walk(by_id[root_id], by_id[root_id]["end_ns"], 0)
+    return out
+
+
+def _format_path(path: List[Dict[str, Any]]) -> str:
+    return "\n".join(
+        f"  {'  ' * p['depth']}{p['name']} {p['duration_ms']} ms (self {p['self_ms']} ms)" for p in path
+    )
+
+
+# --- export ---
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """OTLP/HTTP JSON (ExportTraceServiceRequest) for a batch of records."""
+    spans = []
+    for record in records:
+        for s in record["spans"]:
+            out = {
+                "traceId": record["trace_id"],
+                "spanId": s["span_id"],
+                "name": s["name"],
+                "kind": 2 if "http_method" in s["attrs"] else 1,  # SERVER for the request span, else INTERNAL
+                "startTimeUnixNano": str(s["start_ns"]),
+                "endTimeUnixNano": str(s["end_ns"]),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s["attrs"].items() if v is not None],
+                "status": {"code": 2, "message": s["error"]} if s["error"] else {"code": 1},
+            }
+            if s["parent_id"]:
+                out["parentSpanId"] = s["parent_id"]
+            spans.append(out)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+    }]}
+
+
+class TraceExporter:
+    """
+    Writes finished traces off the request path: records are queued and a
+    background thread appends them to TRACE_FILE (JSON lines, rotated once
+    at TRACE_FILE_MAX_BYTES) and/or posts them to an OTLP/HTTP collector
+    (TRACE_OTLP_ENDPOINT, e.g. http://localhost:4318/v1/traces). When the
+    queue is full, records are dropped rather than slowing requests down.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=EXPORT_QUEUE_MAX)
+        self._thread: Optional[threading.Thread] = None
+        self._write_lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self.dropped = 0
+
+    def submit(self, record: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._thread is None:
+            with self._write_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="trace-export", daemon=True)
+                    self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._export(batch)
+
+    def flush(self) -> None:
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._export(batch)
+
+    def _export(self, batch: List[Dict[str, Any]]) -> None:
+        with self._write_lock:
+            if TRACE_FILE:
+                try:
+                    self._write_file(batch)
+                except OSError as e:
+                    print(f"trace export to {TRACE_FILE} failed: {e}")
+            if TRACE_OTLP_ENDPOINT:
+                try:
+                    if self._client is None:
+                        self._client = httpx.Client(timeout=5.0)
+                    self._client.post(TRACE_OTLP_ENDPOINT, json=_otlp_payload(batch)).raise_for_status()
+                except httpx.HTTPError as e:
+                    print(f"trace export to {TRACE_OTLP_ENDPOINT} failed: {e}")
+
+    def _write_file(self, batch: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(TRACE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE, TRACE_FILE + ".1")
+        # one write per batch; O_APPEND keeps lines from different workers whole
+        with open(TRACE_FILE, "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in batch))
+
+
+exporter = TraceExporter()
+atexit.register(exporter.flush)
+
+# Summaries of this worker's most recent traces, for /debug/traces
+_recent: deque = deque(maxlen=TRACE_KEEP)
+
+
+# --- middleware ---
+
+def _parse_traceparent(value: Optional[str]):
+    # W3C traceparent: 00-<32 hex trace id>-<16 hex parent id>-<flags>
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, False
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None, False
+    return parts[1], parts[2], sampled
+
+
+def _wants_trace(request: Request, sampled_upstream: bool) -> bool:
+    if request.url.path.startswith(router.prefix):
+        return False
+    if sampled_upstream or request.headers.get(TRACE_HEADER, "").lower() in {"1", "true", "yes"}:
+        return True
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+async def trace_requests(request: Request, call_next):
+    """
+    HTTP middleware: trace sampled requests (TRACE_SAMPLE_RATE, `X-Trace: 1`,
+    or a sampled W3C `traceparent`, whose trace id is continued). The trace id
+    is returned in the X-Trace-Id response header. Slow requests
+    (TRACE_SLOW_MS) have their critical path printed.
+    """
+    trace_id, remote_parent, sampled = _parse_traceparent(request.headers.get("traceparent"))
+    if not _wants_trace(request, sampled):
+        return await call_next(request)
+
+    trace = Trace(trace_id, remote_parent)
+    token = _trace.set(trace)
+    parent_token = _parent.set(remote_parent)
+    try:
+        with span(f"{request.method} {request.url.path}", http_method=request.method, http_path=request.url.path) as root:
+            trace.root = root
+            response = await call_next(request)
+            root.set(status_code=response.status_code)
+    finally:
+        _parent.reset(parent_token)
+        _trace.reset(token)
+        record = trace.finish()
+        exporter.submit(record)
+        _recent.append({k: record[k] for k in ("trace_id", "name", "start_ns", "duration_ms", "status_code")})
+        if record["duration_ms"] is not None and record["duration_ms"] >= TRACE_SLOW_MS:
+            print(f"slow request {record['name']} ({record['duration_ms']} ms, trace {trace.trace_id}), critical path:\n{_format_path(record['critical_path'])}")
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
+# --- debug endpoints ---
+
+def _load(trace_id: str) -> Dict[str, Any]:
+    """Merge every exported record of a trace (the request plus any late spans)."""
+    if len(trace_id) != 32 or not trace_id.isalnum():
+        raise HTTPException(status_code=404, detail="Unknown trace")
+    exporter.flush()
+    merged: Optional[Dict[str, Any]] = None
+    late: List[Dict[str, Any]] = []
+    for path in (TRACE_FILE + ".1", TRACE_FILE):
+        if not TRACE_FILE or not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                if trace_id not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("trace_id") != trace_id:
+                    continue
+                if "critical_path" in record:
+                    merged = record
+                else:
+                    late.extend(record["spans"])
+    if merged is None:
+        raise HTTPException(status_code=404, detail="Unknown trace")
+    if late:
+        merged["spans"] = merged["spans"] + late
+        root_id = merged["critical_path"][0]["span_id"] if merged["critical_path"] else None
+        merged["critical_path"] = critical_path(merged["spans"], root_id)
+    return merged
+
+
+@router.get("")
+def list_traces():
+    """This worker's most recent traces, slowest first, without their spans."""
+    return sorted(_recent, key=lambda r: r["duration_ms"] or 0, reverse=True)
+
+
+@router.get("/{trace_id}")
+def get_trace(trace_id: str):
+    """All spans of a trace and its critical path (from TRACE_FILE)."""
+    return _load(trace_id)
@@ -1,7 +1,14 @@
 import os
 import re
+import json
+import asyncio
 from dotenv import load_dotenv
-from config import get_model, MODEL_ID
+from config import get_model, MODEL_ID, LLM_BATCHING, LLM_BATCH_WINDOW_MS, LLM_BATCH_MAX
+from llm_cache import cached_generate, generation_key, response_cache, usage_of
+from llm_batcher import MicroBatcher
+from usage_meter import current_tenant
+from scheduler import current_class
+from description_templates import compose_from_templates
 
 
 load_dotenv()
@@ -10,6 +17,19 @@ model = get_model(MODEL_ID)
 temperature = 0
 n_output = 50
 
+# Bump when the matching prompt template changes so cached responses are invalidated.
+PHRASES_PROMPT_VERSION = "phrases-v1"
+DESCRIPTION_PROMPT_VERSION = "description-v1"
+# Batched prompts are different templates, so their results get their own keys.
+PHRASES_BATCH_PROMPT_VERSION = "phrases-batch-v1"
+DESCRIPTION_BATCH_PROMPT_VERSION = "description-batch-v1"
+
+PHRASES_GENERATION_CONFIG = {
+    "temperature": temperature,
+    "max_output_tokens": 800,
+}
+DESCRIPTION_GENERATION_CONFIG = {"temperature": 0.3}  # keep it restrained
+
 
 
 
@@ -20,15 +40,12 @@ def preprocess_title(title):
     return title
     
 
-def generating_phrases (title):
-  title = preprocess_title(title)
-
-  prompt = f"""You are an assistant that generates short, trademark-friendly, SEO-optimized keyword phrases for Etsy product listings.  
+PHRASES_PREAMBLE = """You are an assistant that generates short, trademark-friendly, SEO-optimized keyword phrases for Etsy product listings.  
 Your goal is to help Etsy sellers improve search visibility while ensuring compliance with Etsy’s rules and trademark law.  
 
-Title: “{title}”
+"""
 
-Instructions:
+PHRASES_INSTRUCTIONS = """Instructions:
 1. Output exactly 50 unique keyword phrases.  
 2. Each phrase must be between 1 and 4 words long.  
 3. Each phrase must appear on its own line with no numbering, bullets, or explanations.  
@@ -50,15 +67,20 @@ Examples of Bad Phrases:
 """
 
 
-  response = model.generate_content(
-    contents=prompt,
-    generation_config={
-            "temperature": temperature,
-            "max_output_tokens": 800,
-        }
+def generating_phrases (title):
+  title = preprocess_title(title)
+
+  prompt = PHRASES_PREAMBLE + f"Title: “{title}”\n\n" + PHRASES_INSTRUCTIONS
+
+
+  return cached_generate(
+    model,
+    MODEL_ID,
+    PHRASES_PROMPT_VERSION,
+    title,
+    prompt,
+    generation_config=PHRASES_GENERATION_CONFIG,
     )
-  
-  return response.text
 
 
 
@@ -116,25 +138,25 @@ def label_and_filter_phrases(generated_text):
     return labeled, safe_only
 
 
+def label_columns(labeled):
+    """Columnar form of label_and_filter_phrases output: one array per field, no emoji."""
+    return {
+        "phrase": [r["phrase"] for r in labeled],
+        "score": [r["score"] for r in labeled],
+        "label": [r["label"] for r in labeled],
+        "reasons": [r["reasons"] for r in labeled],
+    }
 
-def compose_safe_listing_description_from_phrases(
-    title: str,
-    safe_phrases: list[str],
-) -> str:
-    title = (title or "").strip()
-    if not safe_phrases:
-        
-        return title
 
-    
-    phrase_lines = "\n".join(f"- {p}" for p in safe_phrases if p)
 
-    prompt = f"""
+DESCRIPTION_PREAMBLE = """
 You are an expert Etsy copywriter.
 
 You are given a list of SAFE phrases that have already been checked for trademark issues:
 
-{phrase_lines}
+"""
+
+DESCRIPTION_INSTRUCTIONS = """
 
 Your task:
 - Write a short, natural Etsy listing description (2–4 sentences).
@@ -149,19 +171,191 @@ Your task:
 - Output ONLY the final description text—no bullets, no explanations.
 """
 
+
+def compose_safe_listing_description_from_phrases(
+    title: str,
+    safe_phrases: list[str],
+    use_cache: bool = True,
+) -> str:
+    title = (title or "").strip()
+    if not safe_phrases:
+        
+        return title
+
+    
+    phrase_lines = "\n".join(f"- {p}" for p in safe_phrases if p)
+
+    prompt = DESCRIPTION_PREAMBLE + phrase_lines + DESCRIPTION_INSTRUCTIONS
+
     try:
-        response = model.generate_content(
+        text = cached_generate(
+            model,
+            MODEL_ID,
+            DESCRIPTION_PROMPT_VERSION,
+            [title, [p for p in safe_phrases if p]],
             prompt,
-            generation_config={"temperature": 0.3},  # keep it restrained
-        )
-        text = (response.text or "").strip()
+            generation_config=DESCRIPTION_GENERATION_CONFIG,
+            use_cache=use_cache,
+        ).strip()
         if not text:
             # Very conservative fallback
-            return ", ".join(safe_phrases[:5])
+            return compose_from_templates(title, safe_phrases)
         return text
     except Exception as e:
         print(f"compose_safe_listing_description_from_phrases error: {e}")
-        return title or ", ".join(safe_phrases[:5])
+        return compose_from_templates(title, safe_phrases)
+
+
+
+# --- Micro-batched async variants ---
+# Concurrent callers (bulk compose, job workers) are packed into one
+# structured-JSON prompt per window. Results are cached under the batch
+# prompt versions; the async lookups accept either version, while the
+# single-item calls only ever see text from their own template.
+
+def _split_usage(usage: dict, n: int) -> dict:
+    return {k: v // n for k, v in usage.items()}
+
+def _batch_json(prompt: str, n: int, max_output_tokens: int | None, temp: float) -> tuple[dict, dict]:
+    cfg = {"temperature": temp, "response_mime_type": "application/json"}
+    if max_output_tokens:
+        cfg["max_output_tokens"] = max_output_tokens
+    response = model.generate_content(prompt, generation_config=cfg)
+    data = json.loads(response.text)
+    results = data.get("results", []) if isinstance(data, dict) else data
+    by_id = {str(r.get("id")): r for r in results if isinstance(r, dict)}
+    return by_id, _split_usage(usage_of(response), n)
+
+
+def _generate_phrases_batch(titles: list[str]) -> list[str | None]:
+    if len(titles) == 1:
+        return [generating_phrases(titles[0])]
+    items = json.dumps([{"id": str(i), "title": t} for i, t in enumerate(titles)], ensure_ascii=False)
+    prompt = (
+        PHRASES_PREAMBLE
+        + "You will receive several product titles as a JSON array. Treat each title independently "
+        + "and apply all of the instructions below to each one.\n\n"
+        + f"Titles:\n{items}\n\n"
+        + PHRASES_INSTRUCTIONS
+        + '\nOutput format (replaces instruction 3): respond strictly as JSON '
+        + '{"results": [{"id": "<id>", "phrases": ["phrase", ...]}]} with one entry per title.\n'
+    )
+    by_id, usage = _batch_json(prompt, len(titles), 800 * len(titles) + 200, temperature)
+
+    out: list[str | None] = []
+    for i, title in enumerate(titles):
+        phrases = by_id.get(str(i), {}).get("phrases")
+        if not isinstance(phrases, list) or not all(isinstance(p, str) for p in phrases) or not phrases:
+            out.append(None)  # per-item fallback
+            continue
+        text = "\n".join(p.strip() for p in phrases if p.strip())
+        key = generation_key(MODEL_ID, PHRASES_BATCH_PROMPT_VERSION, title, PHRASES_GENERATION_CONFIG)
+        response_cache.put(key, text, usage)
+        out.append(text)
+    return out
+
+
+def _compose_descriptions_batch(items: list[tuple[str, tuple[str, ...]]]) -> list[str | None]:
+    if len(items) == 1:
+        return [None]  # a lone item just uses the single-item prompt
+    listings = json.dumps(
+        [{"id": str(i), "title": title, "safe_phrases": list(phrases)} for i, (title, phrases) in enumerate(items)],
+        ensure_ascii=False,
+    )
+    prompt = (
+        "\nYou are an expert Etsy copywriter.\n\n"
+        "You are given several listings as a JSON array. Each has an id, a title and a list of SAFE "
+        "phrases that have already been checked for trademark issues:\n\n"
+        f"{listings}\n\n"
+        "Apply the task below to each listing separately, using only that listing's phrases."
+        + DESCRIPTION_INSTRUCTIONS
+        + '\nOutput format (replaces the last rule): respond strictly as JSON '
+        + '{"results": [{"id": "<id>", "description": "..."}]} with one entry per listing.\n'
+    )
+    by_id, usage = _batch_json(prompt, len(items), None, DESCRIPTION_GENERATION_CONFIG["temperature"])
+
+    out: list[str | None] = []
+    for i, (title, phrases) in enumerate(items):
+        text = by_id.get(str(i), {}).get("description")
+        if not isinstance(text, str) or not text.strip():
+            out.append(None)
+            continue
+        text = text.strip()
+        key = generation_key(MODEL_ID, DESCRIPTION_BATCH_PROMPT_VERSION, [title, list(phrases)], DESCRIPTION_GENERATION_CONFIG)
+        response_cache.put(key, text, usage)
+        out.append(text)
+    return out
+
+
+def _cached_text(versions: tuple[str, ...], cache_input, generation_config: dict) -> str | None:
+    for version in versions:
+        entry = response_cache.get(generation_key(MODEL_ID, version, cache_input, generation_config))
+        if entry is not None:
+            return entry["text"]
+    return None
+
+
+async def _phrases_fallback(title: str) -> str:
+    return await asyncio.to_thread(generating_phrases, title)
+
+async def _description_fallback(item: tuple[str, tuple[str, ...]]) -> str:
+    title, phrases = item
+    return await asyncio.to_thread(compose_safe_listing_description_from_phrases, title, list(phrases), False)
+
+# Batches never mix tenants, so each batched call is billed to one caller
+def _batch_partition():
+    # a batch is billed to one tenant and scheduled under one traffic class
+    return current_tenant(), current_class()
+
+_phrases_batcher = MicroBatcher(_generate_phrases_batch, _phrases_fallback, LLM_BATCH_WINDOW_MS / 1000, LLM_BATCH_MAX, partition=_batch_partition)
+_description_batcher = MicroBatcher(_compose_descriptions_batch, _description_fallback, LLM_BATCH_WINDOW_MS / 1000, LLM_BATCH_MAX, partition=_batch_partition)
+
+
+async def generating_phrases_async(title: str) -> str:
+    """Async generating_phrases: cache first, then batched with other concurrent titles."""
+    title = preprocess_title(title)
+    cached = await asyncio.to_thread(
+        _cached_text, (PHRASES_PROMPT_VERSION, PHRASES_BATCH_PROMPT_VERSION), title, PHRASES_GENERATION_CONFIG
+    )
+    if cached is not None:
+        return cached
+    if not LLM_BATCHING:
+        return await _phrases_fallback(title)
+    return await _phrases_batcher.submit(title)
+
+
+def cached_description(title: str, safe_phrases) -> str | None:
+    """A previously generated LLM description for exactly these inputs, without calling the model."""
+    phrases = [p for p in safe_phrases if p]
+    text = _cached_text(
+        (DESCRIPTION_PROMPT_VERSION, DESCRIPTION_BATCH_PROMPT_VERSION),
+        [(title or "").strip(), phrases],
+        DESCRIPTION_GENERATION_CONFIG,
+    )
+    return text.strip() if text is not None else None
+
+
+async def compose_safe_listing_description_async(
+    title: str,
+    safe_phrases: list[str],
+    use_cache: bool = True,
+) -> str:
+    """Async compose_safe_listing_description_from_phrases with cross-request batching."""
+    title = (title or "").strip()
+    if not safe_phrases:
+        return title
+    phrases = tuple(p for p in safe_phrases if p)
+    if use_cache:
+        cached = await asyncio.to_thread(cached_description, title, phrases)
+        if cached is not None:
+            return cached
+    if not LLM_BATCHING:
+        return await _description_fallback((title, phrases))
+    try:
+        return await _description_batcher.submit((title, phrases))
+    except Exception as e:
+        print(f"compose_safe_listing_description_async error: {e}")
+        return compose_from_templates(title, safe_phrases)
 
 
 
@@ -0,0 +1,117 @@
+# uploads.py
+import io
+from typing import Any, Optional
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from config import MAX_UPLOAD_BYTES, MAX_IMAGE_PIXELS
+
+READ_CHUNK = 64 * 1024
+
+# Formats Gemini accepts as raw inline bytes; anything else is handed over as a
+# PIL image and re-encoded by the SDK.
+GEMINI_IMAGE_MIME = {"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"}
+
+# ISO-BMFF brands (bytes 8-12 of the "ftyp" box) of HEIC/HEIF files, which PIL can't open
+# without a plugin; those uploads are forwarded to Gemini as-is.
+_HEIF_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+    b"hevc": "image/heic", b"hevx": "image/heic", b"mif1": "image/heif", b"msf1": "image/heif",
+}
+
+
+def _sniff_heif(data: bytes) -> Optional[str]:
+    if len(data) >= 12 and data[4:8] == b"ftyp":
+        return _HEIF_BRANDS.get(data[8:12])
+    return None
+
+
+class ImageUpload:
+    """
+    An uploaded image read exactly once. `data` is the only copy of the bytes:
+    `image` is a lazily-decoded PIL view over it and `part` hands the same
+    buffer to Gemini, so nothing is re-read or re-encoded along the way.
+    `image` is None for formats PIL can't open (HEIC/HEIF); those are only
+    forwarded raw, never downscaled or hashed.
+    """
+
+    def __init__(self, data: bytes, image: Optional[Image.Image], content_type: str):
+        self.data = data
+        self.image = image
+        self.content_type = content_type
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def decodable(self) -> bool:
+        return self.image is not None
+
+    @property
+    def part(self) -> Any:
+        """Request part for model.generate_content."""
+        if self.content_type in GEMINI_IMAGE_MIME:
+            return {"mime_type": self.content_type, "data": self.data}
+        return self.image
+
+    def downscaled_part(self, max_side: int) -> Any:
+        """
+        Request part with the longer side capped at max_side, re-encoded as
+        JPEG (PNG if it has transparency). Returns `part` when the image is
+        already small enough. Decodes pixels, so call it off the event loop.
+        """
+        if self.image is None or max(self.image.size) <= max_side:
+            return self.part
+        # fresh handle so the shared lazy image is left untouched
+        img = Image.open(io.BytesIO(self.data))
+        img.draft("RGB", (max_side, max_side))  # JPEG: decode at reduced scale
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+            img.save(out, format="PNG")
+            return {"mime_type": "image/png", "data": out.getvalue()}
+        img.convert("RGB").save(out, format="JPEG", quality=85)
+        return {"mime_type": "image/jpeg", "data": out.getvalue()}
+
+
+async def read_image_upload(upload: UploadFile, max_bytes: Optional[int] = None) -> ImageUpload:
+    """
+    Read an image upload in chunks, rejecting with 413 as soon as it passes
+    max_bytes, then sniff format and dimensions from the header only
+    (Image.open doesn't decode pixels) so oversized images never get decoded.
+    HEIC/HEIF, which PIL can't open, is recognised from its header and kept
+    as raw bytes for Gemini.
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    if upload.size is not None and upload.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Image larger than {max_bytes} bytes")
+
+    chunks, total = [], 0
+    while True:
+        chunk = await upload.read(READ_CHUNK)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image larger than {max_bytes} bytes")
+        chunks.append(chunk)
+    if not total:
+        raise HTTPException(status_code=400, detail="Empty image file")
+    data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    try:
+        # BytesIO over an immutable bytes object shares its buffer (no copy)
+        image = Image.open(io.BytesIO(data))
+    except Exception as e:
+        heif = _sniff_heif(data)
+        if heif in GEMINI_IMAGE_MIME:
+            return ImageUpload(data, None, heif)
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image dimensions {width}x{height} too large")
+
+    content_type = Image.MIME.get(image.format or "") or upload.content_type or "image/png"
+    return ImageUpload(data, image, content_type)
@@ -0,0 +1,353 @@
+# usage_meter.py
+import time
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request
+
+from cache_store import get_db
+from config import CACHE_ENABLED, TENANT_HEADER, TENANT_BUDGETS, USAGE_FLUSH_INTERVAL, USAGE_FLUSH_MAX_PENDING
+from llm_cache import usage_of
+from tracing import span as trace_span, start_span
+from scheduler import llm_scheduler, current_class
+
+router = APIRouter(prefix="/usage", tags=["usage"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    tenant TEXT NOT NULL,
+    day TEXT NOT NULL,
+    api TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (tenant, day, api)
+) WITHOUT ROWID
+"""
+
+FIELDS = ("calls", "errors", "units", "prompt_tokens", "output_tokens", "total_tokens", "latency_ms")
+
+# Budget name -> (api, counter). Budgets are per tenant per UTC day.
+BUDGETS = {
+    "llm_tokens": ("llm", "total_tokens"),
+    "llm_calls": ("llm", "calls"),
+    "embed_texts": ("embed", "units"),
+    "tm_calls": ("tm", "calls"),
+}
+
+ANONYMOUS = "anonymous"
+
+_tenant: contextvars.ContextVar[str] = contextvars.ContextVar("tenant", default=ANONYMOUS)
+
+
+def current_tenant() -> str:
+    return _tenant.get()
+
+
+@contextmanager
+def billed_to(tenant: str):
+    """Attribute upstream calls made inside the block to `tenant` (e.g. internal work)."""
+    token = _tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def tenant_for_key(api_key: Optional[str]) -> str:
+    # never persist the raw key
+    if not api_key:
+        return ANONYMOUS
+    return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _seconds_to_midnight() -> int:
+    now = datetime.now(timezone.utc)
+    return 86400 - (now.hour * 3600 + now.minute * 60 + now.second)
+
+
+class BudgetExceeded(HTTPException):
+    """Raised instead of an upstream call once the tenant's daily budget is spent."""
+
+    def __init__(self, tenant: str, budget: str):
+        super().__init__(
+            status_code=429,
+            detail=f"Daily {budget} budget exhausted for this API key",
+            headers={"Retry-After": str(_seconds_to_midnight())},
+        )
+        self.tenant = tenant
+        self.budget = budget
+
+
+class UsageMeter:
+    """
+    Per-tenant counters for upstream calls (Gemini generation, embeddings,
+    RapidAPI USPTO). Calls are counted in memory and flushed to the shared
+    SQLite file in batches, every USAGE_FLUSH_INTERVAL seconds or once
+    USAGE_FLUSH_MAX_PENDING calls are pending. Budget checks use the stored
+    totals of every worker plus this process's unflushed counts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        self._pending_calls = 0
+        self._stored: Dict[Tuple[str, str], Tuple[float, Dict[str, Dict[str, float]]]] = {}
+        self._flusher: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+
+    # --- recording ---
+
+    def record(self, api: str, latency_ms: float, units: int = 0, usage: Optional[Dict[str, int]] = None, error: bool = False) -> None:
+        key = (current_tenant(), _today(), api)
+        with self._lock:
+            row = self._pending.setdefault(key, dict.fromkeys(FIELDS, 0))
+            row["calls"] += 1
+            row["errors"] += int(error)
+            row["units"] += units
+            row["latency_ms"] += latency_ms
+            for name, value in (usage or {}).items():
+                row[name] += value
+            self._pending_calls += 1
+            full = self._pending_calls >= USAGE_FLUSH_MAX_PENDING
+        self._ensure_flusher()
+        if full:
+            self._wake.set()
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None and CACHE_ENABLED:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="usage-flush", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wake.wait(USAGE_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._pending, self._pending_calls = self._pending, {}, 0
+        if not batch or not CACHE_ENABLED:
+            return
+        rows = [(*key, *(row[f] for f in FIELDS)) for key, row in batch.items()]
+        updates = ", ".join(f"{f} = {f} + excluded.{f}" for f in FIELDS)
+        try:
+            conn = get_db()
+            conn.execute(_SCHEMA)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    f"INSERT INTO usage (tenant, day, api, {', '.join(FIELDS)}) VALUES (?, ?, ?, {', '.join('?' * len(FIELDS))}) "
+                    f"ON CONFLICT (tenant, day, api) DO UPDATE SET {updates}",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            print(f"usage flush failed, keeping counts for the next one: {e}")
+            with self._lock:
+                for key, row in batch.items():
+                    merged = self._pending.setdefault(key, dict.fromkeys(FIELDS, 0))
+                    for f in FIELDS:
+                        merged[f] += row[f]
+            return
+        with self._lock:
+            for tenant, day, _ in batch:
+                self._stored.pop((tenant, day), None)
+
+    # --- reading ---
+
+    def _cached_stored(self, tenant: str, day: str) -> Optional[Dict[str, Dict[str, float]]]:
+        cached = self._stored.get((tenant, day))
+        if cached is not None and time.monotonic() - cached[0] < USAGE_FLUSH_INTERVAL:
+            return cached[1]
+        return None
+
+    def _stored_usage(self, tenant: str, day: str) -> Dict[str, Dict[str, float]]:
+        cached = self._cached_stored(tenant, day)
+        if cached is not None:
+            return cached
+        out: Dict[str, Dict[str, float]] = {}
+        if CACHE_ENABLED:
+            try:
+                conn = get_db()
+                conn.execute(_SCHEMA)
+                for api, *values in conn.execute(
+                    f"SELECT api, {', '.join(FIELDS)} FROM usage WHERE tenant = ? AND day = ?", (tenant, day)
+                ):
+                    out[api] = dict(zip(FIELDS, values))
+            except sqlite3.Error as e:
+                print(f"usage read failed: {e}")
+        self._stored[(tenant, day)] = (time.monotonic(), out)
+        return out
+
+    def _with_pending(self, stored: Dict[str, Dict[str, float]], tenant: str, day: str) -> Dict[str, Dict[str, float]]:
+        out = {api: dict(row) for api, row in stored.items()}
+        with self._lock:
+            for (t, d, api), row in self._pending.items():
+                if t == tenant and d == day:
+                    merged = out.setdefault(api, dict.fromkeys(FIELDS, 0))
+                    for f in FIELDS:
+                        merged[f] += row[f]
+        return out
+
+    def usage(self, tenant: Optional[str] = None, day: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """Today's counters per api for a tenant, across all workers."""
+        tenant = tenant or current_tenant()
+        day = day or _today()
+        return self._with_pending(self._stored_usage(tenant, day), tenant, day)
+
+    # --- budgets ---
+
+    def budgets(self, tenant: Optional[str] = None) -> Dict[str, float]:
+        tenant = tenant or current_tenant()
+        return {**TENANT_BUDGETS.get("default", {}), **TENANT_BUDGETS.get(tenant, {})}
+
+    @staticmethod
+    def _exhausted(api: str, limits: Dict[str, float], used: Dict[str, Dict[str, float]]) -> Optional[str]:
+        for budget, limit in limits.items():
+            budget_api, counter = BUDGETS.get(budget, (None, None))
+            if budget_api == api and used.get(api, {}).get(counter, 0) >= limit:
+                return budget
+        return None
+
+    def over_budget(self, api: str) -> Optional[str]:
+        """Name of the first exhausted budget that covers `api`, or None. May read SQLite; see over_budget_async."""
+        limits = self.budgets()
+        if not limits:
+            return None
+        return self._exhausted(api, limits, self.usage())
+
+    async def over_budget_async(self, api: str) -> Optional[str]:
+        """over_budget for the event loop: a stale stored-usage snapshot is re-read in a worker thread."""
+        limits = self.budgets()
+        if not limits:
+            return None
+        tenant, day = current_tenant(), _today()
+        stored = self._cached_stored(tenant, day)
+        if stored is None:
+            stored = await asyncio.to_thread(self._stored_usage, tenant, day)
+        return self._exhausted(api, limits, self._with_pending(stored, tenant, day))
+
+    def check(self, api: str) -> None:
+        budget = self.over_budget(api)
+        if budget is not None:
+            raise BudgetExceeded(current_tenant(), budget)
+
+
+meter = UsageMeter()
+atexit.register(meter.flush)
+
+
+# --- Gemini generation ---
+
+class _MeteredStream:
+    """Iterates a streaming response and records usage once it is exhausted."""
+
+    def __init__(self, response, started: float, trace, release):
+        self._response = response
+        self._started = started
+        self._trace = trace
+        self._release = release
+
+    def __iter__(self) -> Iterator[Any]:
+        usage: Dict[str, int] = {}
+        error = False
+        try:
+            for chunk in self._response:
+                usage = usage_of(chunk) if getattr(chunk, "usage_metadata", None) else usage
+                yield chunk
+        except Exception:
+            error = True
+            raise
+        finally:
+            meter.record("llm", (time.perf_counter() - self._started) * 1000, usage=usage, error=error)
+            self._trace.set(**usage)
+            self._trace.end("stream failed" if error else None)
+            self._release()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._response, name)
+
+
+class MeteredModel:
+    """
+    GenerativeModel wrapper returned by config.get_model: refuses calls once
+    the tenant's LLM budget is spent, waits for an llm_scheduler slot for the
+    request's traffic class, and records tokens (usage_metadata), call count
+    and latency for every generate_content. Streams hold their slot until read.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._model, name)
+
+    def generate_content(self, *args, **kwargs):
+        meter.check("llm")
+        model_name = getattr(self._model, "model_name", None)
+        if kwargs.get("stream"):
+            # the span and the slot are held until the stream has been read to the end
+            stream_span = start_span("llm.generate", model=model_name, stream=True)
+            cls = current_class()
+            with trace_span("scheduler.wait", upstream=llm_scheduler.name, traffic_class=cls):
+                llm_scheduler.acquire(cls)
+            started = time.perf_counter()
+            try:
+                response = self._model.generate_content(*args, **kwargs)
+            except Exception as e:
+                meter.record("llm", (time.perf_counter() - started) * 1000, error=True)
+                stream_span.end(f"{type(e).__name__}: {e}")
+                llm_scheduler.release(cls)
+                raise
+            return _MeteredStream(response, started, stream_span, lambda: llm_scheduler.release(cls))
+        with trace_span("llm.generate", model=model_name) as s, llm_scheduler.slot():
+            started = time.perf_counter()
+            try:
+                response = self._model.generate_content(*args, **kwargs)
+            except Exception:
+                meter.record("llm", (time.perf_counter() - started) * 1000, error=True)
+                raise
+            usage = usage_of(response)
+            meter.record("llm", (time.perf_counter() - started) * 1000, usage=usage)
+            s.set(**usage)
+        return response
+
+
+# --- middleware & endpoint ---
+
+async def assign_tenant(request: Request, call_next):
+    """HTTP middleware: bill the request to the API key in TENANT_HEADER."""
+    token = _tenant.set(tenant_for_key(request.headers.get(TENANT_HEADER)))
+    try:
+        return await call_next(request)
+    finally:
+        _tenant.reset(token)
+
+
+@router.get("")
+def get_usage():
+    """Today's usage and budgets for the calling API key."""
+    return {
+        "tenant": current_tenant(),
+        "day": _today(),
+        "usage": meter.usage(),
+        "budgets": meter.budgets(),
+    }
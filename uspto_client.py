@@ -1,9 +1,17 @@
 # uspto_client.py
 import os
+import time
+import asyncio
 import urllib.parse
 from typing import Optional, Dict, Any
 import httpx
 
+from config import TM_CACHE_TTL
+from cache_store import SharedCache, make_key
+from usage_meter import meter
+from tracing import span
+from scheduler import tm_scheduler
+
 RAPIDAPI_HOST = "uspto-trademark.p.rapidapi.com"
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY") or os.getenv("X_RAPIDAPI_KEY")  # allow either name
 
@@ -20,30 +28,83 @@ BASE = f"https://{RAPIDAPI_HOST}/v1"
 class TMError(Exception):
     pass
 
+# One pooled client per event loop so the TLS session to RapidAPI is reused
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20))
+        _client_loop = loop
+    return _client
+
+async def warm_up() -> None:
+    """Open the pooled connection (DNS + TLS) with an unauthenticated, unbilled request."""
+    await get_client().head(f"https://{RAPIDAPI_HOST}/")
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Verdicts are shared across workers; only 2xx responses are cached.
+_tm_cache = SharedCache("tm", ttl=TM_CACHE_TTL)
+
+def _cacheable(resp: Dict[str, Any]) -> bool:
+    code = resp.get("status_code")
+    # only real verdicts; 4xx (bad key, plan limits) would block phrases long after it's fixed
+    return resp.get("error") is None and isinstance(code, int) and 200 <= code < 300
+
 async def check_trademark_available(term: str) -> Dict[str, Any]:
     """
     GET /v1/trademarkAvailable/{term}
     Be tolerant of non-JSON and non-200 responses; never raise here.
+    Once the tenant's USPTO budget is spent only cached verdicts are served;
+    anything else comes back as an error, i.e. not verified safe.
     """
+    with span("uspto.check", term=term) as s:
+        resp = await _check_trademark_available(term)
+        s.set(status_code=resp.get("status_code"), error=resp.get("error"))
+        return resp
+
+async def _check_trademark_available(term: str) -> Dict[str, Any]:
+    key = make_key(term.strip().lower())
+    cached = await _tm_cache.get_async(key)
+    if cached is not None:
+        return cached
+
+    budget = await meter.over_budget_async("tm")
+    if budget is not None:
+        return {"status_code": None, "payload": None, "error": f"{budget} budget exhausted (cached verdicts only)"}
+
     safe_term = urllib.parse.quote(term)
     url = f"{BASE}/trademarkAvailable/{safe_term}"
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(url, headers=HEADERS)
-    except Exception as e:
-        # Network/transport error
-        return {"status_code": None, "payload": None, "error": f"http error: {e}"}
+    async with tm_scheduler.slot_async():
+        started = time.perf_counter()
+        try:
+            r = await get_client().get(url, headers=HEADERS)
+        except Exception as e:
+            # Network/transport error
+            meter.record("tm", (time.perf_counter() - started) * 1000, error=True)
+            return {"status_code": None, "payload": None, "error": f"http error: {e}"}
+    meter.record("tm", (time.perf_counter() - started) * 1000, error=r.status_code >= 500 or r.status_code == 429)
 
     try:
         payload = r.json()
     except Exception:
         payload = {"raw": r.text}
 
-    return {
+    resp = {
         "status_code": r.status_code,
         "payload": payload,   # could be dict/list/str-ish
         "error": None
     }
+    if _cacheable(resp):
+        await _tm_cache.set_async(key, resp)
+    return resp
 
 
 async def fulltext_search(term: str) -> Dict[str, Any]:
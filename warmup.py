@@ -0,0 +1,84 @@
+# warmup.py
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+import numpy as np
+from PIL import Image
+
+from config import MODEL_ID, WARMUP_ENABLED, WARMUP_UPSTREAM, WARMUP_TIMEOUT, get_model
+from cache_store import get_db
+from tag_index import tag_index
+from image_dedupe import image_index
+from tmcheck_api import mark_matcher
+from usage_meter import meter, billed_to
+import services_embed
+import uspto_client
+
+WARMUP_TENANT = "system:warmup"
+
+# Reported by /health; ready flips once warm-up has finished (or was skipped)
+warmup_state: Dict[str, Any] = {
+    "ready": not WARMUP_ENABLED,
+    "duration_ms": None,
+    "steps": {},
+}
+
+
+def _warm_local() -> None:
+    get_db()                      # cache file, WAL mode, expired-row sweeper
+    meter.usage(WARMUP_TENANT)    # usage table
+    tag_index.refresh()           # index rows (IVF lists build in the background when large)
+    image_index.refresh()         # perceptual hashes of processed uploads
+    mark_matcher()
+    Image.init()                  # register every PIL format plugin up front
+    m = np.ones((64, 64), dtype=np.float32)
+    m @ m                         # BLAS thread pool
+
+
+def _warm_generate() -> None:
+    get_model(MODEL_ID).generate_content("ping", generation_config={"max_output_tokens": 1})
+
+
+async def _step(name: str, fn: Callable[[], Awaitable[Any]]) -> None:
+    started = time.perf_counter()
+    try:
+        await fn()
+        warmup_state["steps"][name] = {"ok": True}
+    except Exception as e:
+        print(f"warm-up step '{name}' failed: {e}")
+        warmup_state["steps"][name] = {"ok": False, "error": str(e)}
+    warmup_state["steps"][name]["ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+async def warm_up() -> None:
+    """
+    Run before the worker takes traffic (main.py lifespan): build local
+    state and open upstream connections concurrently, so the first user
+    requests don't pay for cold channels, TLS handshakes and lazy loads.
+    A failed step is logged and recorded, never fatal; the whole phase is
+    capped at WARMUP_TIMEOUT seconds.
+    """
+    if not WARMUP_ENABLED:
+        return
+    started = time.perf_counter()
+    steps = {"local": lambda: asyncio.to_thread(_warm_local)}
+    if WARMUP_UPSTREAM:
+        steps.update({
+            "uspto": uspto_client.warm_up,
+            "gemini_embed": lambda: asyncio.to_thread(services_embed.warm_up),
+            "gemini_generate": lambda: asyncio.to_thread(_warm_generate),
+        })
+    with billed_to(WARMUP_TENANT):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(_step(name, fn) for name, fn in steps.items())),
+                timeout=WARMUP_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            print(f"warm-up timed out after {WARMUP_TIMEOUT}s, serving anyway")
+            for name in steps:
+                warmup_state["steps"].setdefault(name, {"ok": False, "error": "timeout"})
+    warmup_state["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    warmup_state["ready"] = True
+    print(f"warm-up finished in {warmup_state['duration_ms']} ms: {warmup_state['steps']}")